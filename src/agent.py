@@ -0,0 +1,307 @@
+""" The pol agent keeps a safe open in the background, like ssh-agent.
+
+    The agent listens on a unix socket.  Every command run by a `Client'
+    still needs the password of a container, but as the agent keeps the
+    safe loaded and remembers stretched passwords, it is answered in
+    milliseconds.  Changes are stored and the safe is rerandomized every
+    `save_interval' seconds and when the agent stops.
+
+    A client only gets the access to a container that the passwords
+    it gave grant: with a list password, it cannot read the secrets,
+    even if another client opened the container with its master password.
+
+    A request and its reply are msgpack encoded lists, each preceded by
+    its length as a big-endian 32-bit integer.  A request is the name
+    of an operation followed by its arguments.  See `Agent._handle'. """
+
+import os
+import time
+import struct
+import socket
+import logging
+import threading
+import socketserver
+
+import msgpack
+
+import pol.safe
+
+l = logging.getLogger(__name__)
+
+# The environment variable with the path of the socket of the agent
+SOCKET_ENV_VAR = 'POL_AGENT_SOCK'
+
+_length_struct = struct.Struct('>I')
+
+class AgentError(Exception):
+    pass
+
+def _send(sock, obj):
+    packed = msgpack.packb(obj, use_bin_type=True)
+    sock.sendall(_length_struct.pack(len(packed)) + packed)
+
+def _recv_exactly(sock, n):
+    """ Reads `n' bytes from `sock'.  Returns None at the end of the
+        stream. """
+    bits = []
+    while n:
+        bit = sock.recv(n)
+        if not bit:
+            return None
+        bits.append(bit)
+        n -= len(bit)
+    return b''.join(bits)
+
+def _recv(sock):
+    """ Receives an object sent with `_send'.  Returns None at the end of
+        the stream. """
+    packed_length = _recv_exactly(sock, _length_struct.size)
+    if packed_length is None:
+        return None
+    packed = _recv_exactly(sock, _length_struct.unpack(packed_length)[0])
+    if packed is None:
+        raise AgentError("Connection closed halfway a message")
+    return msgpack.unpackb(packed, raw=False)
+
+# The access a password gives to a container, from most to least.
+# See `Safe.open_containers'.
+_ACCESS_ORDER = (pol.safe.AS_FULL, pol.safe.AS_LIST, pol.safe.AS_APPEND)
+
+class Agent(object):
+    """ Serves the opened ElGamalSafe `safe' on the unix socket `path'.
+
+        `save' is called, without arguments, to rerandomize and store
+        the safe every `save_interval' seconds if it has been used.
+        `safe_path' is the path of the safe, which clients compare to the
+        safe they want to use. """
+
+    def __init__(self, safe, path, save, save_interval, safe_path=None):
+        self.safe = safe
+        self.path = path
+        self.save = save
+        self.save_interval = save_interval
+        self.safe_path = (os.path.realpath(safe_path)
+                                if safe_path is not None else None)
+        # The containers opened by any client, by their id
+        self.containers = {}
+        # Held while the safe is used
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.used = False
+        self.server = None
+
+    def bind(self):
+        """ Creates the socket, which only the current user can access. """
+        old_umask = os.umask(0o177)
+        try:
+            self.server = _AgentServer(self.path, _AgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.agent = self
+        # Stops `handle_request' regularly, to check `stopped'.
+        self.server.timeout = 0.5
+
+    def serve(self):
+        """ Handles requests until the agent is stopped. """
+        if self.server is None:
+            self.bind()
+        l.info('Agent listening on %s', self.path)
+        last_save = time.time()
+        try:
+            while not self.stopped:
+                self.server.handle_request()
+                if self.used and time.time() - last_save > self.save_interval:
+                    with self.lock:
+                        l.debug('Agent: saving safe')
+                        self.save()
+                        self.used = False
+                    last_save = time.time()
+        finally:
+            self.server.server_close()
+            os.unlink(self.path)
+
+    def stop(self):
+        """ Lets `serve' return.  Safe to call from a signal handler. """
+        self.stopped = True
+
+    def _handle(self, request, opened):
+        """ Handles the `request' of a client that opened the containers
+            `opened', which maps their id to the pair (container, access)
+            where `access' is the most access the client proved. """
+        op = None
+        try:
+            op, args = request[0], request[1:]
+            with self.lock:
+                self.used = True
+                if op == 'open-containers':
+                    password, additional_keys = args
+                    ret = []
+                    for container, access in self.safe.open_containers(
+                                        password,
+                                        additional_keys=additional_keys,
+                                        with_access=True):
+                        self.containers[container.id] = container
+                        if container.id in opened:
+                            access = min(access, opened[container.id][1],
+                                         key=_ACCESS_ORDER.index)
+                        opened[container.id] = (container, access)
+                        ret.append([container.id,
+                                    _can_add(container, access)])
+                    return [True, ret]
+                if op == 'safe-path':
+                    return [True, self.safe_path]
+                if op == 'stop':
+                    self.stop()
+                    return [True, None]
+                if args[0] not in opened:
+                    raise AgentError("Container %r is not opened" % args[0])
+                container, access = opened[args[0]]
+                if op == 'list':
+                    if access == pol.safe.AS_APPEND:
+                        raise pol.safe.MissingKey
+                    return [True, [[entry.key, entry.note]
+                                        for entry in container.list()]]
+                if op == 'get':
+                    if access == pol.safe.AS_APPEND:
+                        raise pol.safe.MissingKey
+                    ret = []
+                    for entry in container.get(args[1]):
+                        has_secret = (entry.has_secret
+                                        and access == pol.safe.AS_FULL)
+                        ret.append([entry.key, entry.note,
+                                    entry.secret if has_secret else None,
+                                    has_secret])
+                    return [True, ret]
+                if op == 'add':
+                    if not _can_add(container, access):
+                        raise pol.safe.MissingKey
+                    container.add(*args[1:])
+                    return [True, None]
+                if op == 'save':
+                    container.save()
+                    return [True, None]
+            raise AgentError("Unknown operation %r" % op)
+        except pol.safe.MissingKey:
+            return [False, 'MissingKey', None]
+        except KeyError as e:
+            return [False, 'KeyError', str(e)]
+        except Exception as e:
+            l.exception('Agent: error handling %r', op)
+            return [False, type(e).__name__, str(e)]
+
+def _can_add(container, access):
+    """ Returns whether `access' to `container' suffices to add entries. """
+    if access == pol.safe.AS_FULL:
+        return container.can_add
+    # The other passwords can only add to the append slice
+    return container.append_data is not None
+
+class _AgentServer(socketserver.ThreadingMixIn,
+                   socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _AgentRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # The containers opened by this client
+        opened = {}
+        while True:
+            request = _recv(self.request)
+            if request is None:
+                return
+            _send(self.request, self.server.agent._handle(request, opened))
+
+class Client(object):
+    """ Connects to the agent listening on the unix socket `path'.
+
+        A Client can stand in for an opened safe: see `open_containers'. """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+
+    @staticmethod
+    def from_environment():
+        """ Connects to the agent set in the environment.  Returns None if
+            there is none, or if it cannot be reached. """
+        path = os.environ.get(SOCKET_ENV_VAR)
+        if not path:
+            return None
+        try:
+            return Client(path)
+        except OSError as e:
+            l.warning('Could not connect to agent at %s: %s', path, e)
+            return None
+
+    def call(self, op, *args):
+        _send(self.sock, [op] + list(args))
+        reply = _recv(self.sock)
+        if reply is None:
+            raise AgentError("The agent closed the connection")
+        if reply[0]:
+            return reply[1]
+        if reply[1] == 'MissingKey':
+            raise pol.safe.MissingKey
+        if reply[1] == 'KeyError':
+            raise KeyError(reply[2])
+        raise AgentError("%s: %s" % (reply[1], reply[2]))
+
+    def open_containers(self, password, additional_keys=None,
+                            on_move_append_entries=None):
+        """ Opens the containers with `password', like
+            `Safe.open_containers'.  Entries moved from the append-slice
+            are not reported. """
+        return [RemoteContainer(self, container_id, can_add)
+                    for container_id, can_add in self.call('open-containers',
+                                            password, additional_keys or [])]
+
+    def safe_path(self):
+        """ Returns the real path of the safe of the agent, if known. """
+        return self.call('safe-path')
+
+    def stop(self):
+        """ Stops the agent. """
+        self.call('stop')
+
+    def close(self):
+        self.sock.close()
+
+class RemoteContainer(object):
+    """ A container opened by an agent.  See `Client.open_containers'. """
+
+    def __init__(self, client, container_id, can_add):
+        self.client = client
+        self.id = container_id
+        self.can_add = can_add
+
+    def list(self):
+        return [RemoteEntry(key, note, None, False)
+                    for key, note in self.client.call('list', self.id)]
+
+    def get(self, key):
+        return [RemoteEntry(*entry)
+                    for entry in self.client.call('get', self.id, key)]
+
+    def add(self, key, note, secret):
+        self.client.call('add', self.id, key, note, secret)
+
+    def save(self):
+        self.client.call('save', self.id)
+
+class RemoteEntry(object):
+    """ An entry of a RemoteContainer """
+
+    def __init__(self, key, note, secret, has_secret):
+        self.key = key
+        self.note = note
+        self._secret = secret
+        self.has_secret = has_secret
+
+    @property
+    def secret(self):
+        if not self.has_secret:
+            raise pol.safe.MissingKey
+        return self._secret
@@ -0,0 +1,135 @@
+""" Fixed-width storage for the blocks of a safe. """
+
+import struct
+
+# The size of the marker of a block.  See `ElGamalSafe._marker_for_block'.
+MARKER_SIZE = 32
+
+class BlockStore(object):
+    """ Stores a list of blocks [c1, c2, pubkey, marker] of byte strings as
+        fixed-width records in a single buffer.
+
+        c1, c2 and pubkey are at most `width' bytes long and the marker is
+        at most `marker_width' bytes long.  A record consists of the four
+        lengths as big-endian 16-bit integers, followed by the four values,
+        each padded with zeroes to its width.  The records start at `offset'
+        in `buf', which might be, for instance, a mmap of a safe.
+
+        Indexing a BlockStore returns a new list: to change a block,
+        assign the whole block. """
+
+    __slots__ = ('nblocks', 'width', 'marker_width', 'record', 'record_size',
+                 'marker_record', 'buf', 'offset')
+
+    def __init__(self, nblocks, width, marker_width=MARKER_SIZE, buf=None,
+                    offset=0):
+        self.nblocks = nblocks
+        self.width = width
+        self.marker_width = marker_width
+        self.record = struct.Struct('>HHHH%ds%ds%ds%ds' % (
+                                    width, width, width, marker_width))
+        self.record_size = self.record.size
+        # Only the length and value of the marker
+        self.marker_record = struct.Struct('>6xH%dx%ds' % (3 * width,
+                                                           marker_width))
+        if buf is None:
+            buf = bytearray(self.record_size * nblocks)
+        if len(buf) < offset + self.record_size * nblocks:
+            raise ValueError("`buf' is too small")
+        self.buf = buf
+        self.offset = offset
+
+    @staticmethod
+    def from_list(blocks, width, marker_width=MARKER_SIZE):
+        """ Creates a BlockStore with the blocks from the list `blocks'. """
+        store = BlockStore(len(blocks), width, marker_width)
+        for index, block in enumerate(blocks):
+            store[index] = block
+        return store
+
+    def __len__(self):
+        return self.nblocks
+
+    def _record_offset(self, index):
+        if index < 0:
+            index += self.nblocks
+        if not 0 <= index < self.nblocks:
+            raise IndexError("block index out of range")
+        return self.offset + index * self.record_size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.nblocks))]
+        l1, l2, l3, l4, c1, c2, pubkey, marker = self.record.unpack_from(
+                                        self.buf, self._record_offset(index))
+        return [c1[:l1], c2[:l2], pubkey[:l3], marker[:l4]]
+
+    def __setitem__(self, index, block):
+        c1, c2, pubkey, marker = block
+        if max(len(c1), len(c2), len(pubkey)) > self.width:
+            raise ValueError("value is longer than `width'")
+        if len(marker) > self.marker_width:
+            raise ValueError("marker is longer than `marker_width'")
+        self.record.pack_into(self.buf, self._record_offset(index),
+                              len(c1), len(c2), len(pubkey), len(marker),
+                              c1, c2, pubkey, marker)
+
+    def __iter__(self):
+        for l1, l2, l3, l4, c1, c2, pubkey, marker in self.record.iter_unpack(
+                                                                self.region()):
+            yield [c1[:l1], c2[:l2], pubkey[:l3], marker[:l4]]
+
+    def __reduce__(self):
+        # We only pickle our own records: see `view'.
+        return (BlockStore, (self.nblocks, self.width, self.marker_width,
+                             bytearray(self.region())))
+
+    def view(self, start, stop):
+        """ Returns a BlockStore for the blocks [start, stop) that shares
+            the buffer with this one: changes to the one are visible in
+            the other.  When pickled, it contains only its own blocks. """
+        if not 0 <= start <= stop <= self.nblocks:
+            raise IndexError("block index out of range")
+        return BlockStore(stop - start, self.width, self.marker_width,
+                          self.buf, self.offset + start * self.record_size)
+
+    def take(self, indices):
+        """ Returns a new BlockStore with copies of the blocks `indices'. """
+        ret = BlockStore(len(indices), self.width, self.marker_width)
+        region = self.region()
+        ret_region = ret.region()
+        size = self.record_size
+        for i, index in enumerate(indices):
+            offset = self._record_offset(index) - self.offset
+            ret_region[i*size:(i+1)*size] = region[offset:offset+size]
+        return ret
+
+    def put(self, indices, store):
+        """ Copies the blocks of `store' to the blocks `indices'.
+            The inverse of `take'. """
+        if (len(indices) != len(store) or self.width != store.width
+                or self.marker_width != store.marker_width):
+            raise ValueError("`store' does not match")
+        region = self.region()
+        store_region = store.region()
+        size = self.record_size
+        for i, index in enumerate(indices):
+            offset = self._record_offset(index) - self.offset
+            region[offset:offset+size] = store_region[i*size:(i+1)*size]
+
+    def markers(self):
+        """ Iterates over the markers of the blocks. """
+        for length, marker in self.marker_record.iter_unpack(self.region()):
+            yield marker[:length]
+
+    def region(self):
+        """ Returns a memoryview on the records in the buffer. """
+        return memoryview(self.buf)[self.offset:
+                                self.offset + self.record_size * self.nblocks]
+
+    @property
+    def params(self):
+        """ The parameters of the layout of the records, as stored
+            in the header of a safe. """
+        return {b'width': self.width,
+                b'marker-width': self.marker_width}
@@ -22,6 +22,7 @@ elif 'POL_NO_DEMANDIMPORT' not in os.environ:
     demandimport.ignore('_compat_pickle') # TODO investigate
     demandimport.ignore('numbers')        #      ibidem
     demandimport.ignore('gmpy2')          #      ibidem
+    demandimport.ignore('msvcrt') # subprocess expects ModuleNotFoundError
     demandimport.enable()
 
 import contextlib
@@ -35,6 +36,10 @@ import pprint
 import shlex
 import time
 import math
+import signal
+import shutil
+import tempfile
+import functools
 import csv
 import re
 
@@ -43,6 +48,8 @@ import pol.vi
 import pol.ks
 import pol.text
 import pol.safe
+import pol.agent
+import pol.session
 import pol.passgen
 import pol.terminal
 import pol.humanize
@@ -77,6 +84,15 @@ cracktimes = {'seconds':     10,
               'ages':        10*60*60*24*365*1000000,
               'astronomical':10*60*60*24*365*1000000000}
 
+# Number of seconds after which `pol shell' stores and closes an idle safe,
+# unless `shell-idle-timeout' is set.
+DEFAULT_SHELL_IDLE_TIMEOUT = 300
+
+# Defaults for `pol agent': the number of seconds after which the safe is
+# stored if it has been used, and how long stretched passwords are kept.
+DEFAULT_AGENT_SAVE_INTERVAL = 60
+DEFAULT_AGENT_KS_CACHE_TIMEOUT = 3600
+
 # TODO add commands
 #   pol rename
 #       regenerate
@@ -86,6 +102,14 @@ class Program(object):
     def __init__(self):
         # Contents of keyfiles, if provided
         self.additional_keys = None
+        # See `_start_ks_cache'
+        self.ks_cache = None
+        # The safe kept open by `pol shell' and the context in which it
+        # was opened.  See `_open_shell_safe'.
+        self.in_shell = False
+        self.shell_safe = None
+        self.shell_session = None
+        self._shell_safe_stack = None
 
     def parse_args(self, argv):
         """ Parse command line arguments.  Sets self.args. """
@@ -321,6 +345,19 @@ class Program(object):
                     help='Compose passwords with the contents of these files')
         p_raw.set_defaults(func=self.cmd_raw)
 
+        # pol convert
+        p_convert = subparsers.add_parser('convert', add_help=False,
+                    help='Stores the safe in another file format')
+        p_convert.add_argument('-h', '--help', action='help',
+                    help='show this help message and exit')
+        p_convert.add_argument('--to', choices=pol.safe.FORMATS,
+                    default=pol.safe.FORMAT_FIXED,
+                    help='The format to convert to.  "fixed" (default) '+
+                         'stores the blocks such that they can be read '+
+                         'on demand.  "msgpack" is the format of pol '+
+                         'before 0.5.')
+        p_convert.set_defaults(func=self.cmd_convert)
+
         # pol import-psafe3
         p_import_psafe3 = subparsers.add_parser('import-psafe3', add_help=False,
                     help='Imports entries from a psafe3 db')
@@ -416,6 +453,28 @@ class Program(object):
                     help='Compose passwords with the contents of these files')
         p_shell.set_defaults(func=self.cmd_shell)
 
+        # pol save
+        p_save = subparsers.add_parser('save', add_help=False,
+                    help='Rerandomize and store the safe opened by the shell')
+        p_save_b = p_save.add_argument_group('basic options')
+        p_save_b.add_argument('-h', '--help', action='help',
+                    help='show this help message and exit')
+        p_save.set_defaults(func=self.cmd_save)
+
+        # pol agent
+        p_agent = subparsers.add_parser('agent', add_help=False,
+                    help='Keep the safe open in the background')
+        p_agent_b = p_agent.add_argument_group('basic options')
+        p_agent_b.add_argument('-h', '--help', action='help',
+                    help='show this help message and exit')
+        p_agent_b.add_argument('--stop', '-k', action='store_true',
+                    help='Stop the agent set in $%s' %
+                            pol.agent.SOCKET_ENV_VAR)
+        p_agent_a = p_agent.add_argument_group('advanced options')
+        p_agent_a.add_argument('--socket', '-a', metavar='PATH',
+                    help='Path of the socket to listen on')
+        p_agent.set_defaults(func=self.cmd_agent)
+
         # pol vi
         p_vi = subparsers.add_parser('vi',
                         add_help=False,
@@ -468,7 +527,10 @@ class Program(object):
             l.debug('Loading cached configuration file %s ...', cached_path)
             with open(cached_path, 'rb') as f:
                 try:
-                    self.config = msgpack.load(f, raw=True)
+                    # The cache is written with use_bin_type=True.  We ask
+                    # for str explicitly, as msgpack before 1.0 returns
+                    # bytes by default, which would hide every setting.
+                    self.config = msgpack.load(f, raw=False)
                     l.debug('    ... done')
                     return
                 except Exception as e:
@@ -477,7 +539,7 @@ class Program(object):
         l.debug('Loading configuration file %s ...', path)
         with open(path, 'rb') as f:
             try:
-                self.config = yaml.load(f)
+                self.config = yaml.safe_load(f)
                 if not self.config:
                     self.config = {}
             except yaml.YAMLError as e:
@@ -488,6 +550,22 @@ class Program(object):
         with open(cached_path, 'wb') as f:
             msgpack.dump(self.config, f, use_bin_type=True)
 
+    def check_configuration(self):
+        """ Checks the values in self.config """
+        safe_format = self.config.get('safe-format')
+        if safe_format is not None and safe_format not in pol.safe.FORMATS:
+            sys.stderr.write("safe-format in configuration file should be "+
+                             "one of: %s\n" % ', '.join(pol.safe.FORMATS))
+            return -18
+        fraction = self.config.get('rerandomize-fraction')
+        if fraction is not None and (isinstance(fraction, bool)
+                    or not isinstance(fraction, (int, float))
+                    or not 0 < fraction <= 1):
+            sys.stderr.write("rerandomize-fraction in configuration file "+
+                             "should be a number larger than 0 and at "+
+                             "most 1\n")
+            return -18
+
     def main(self, argv, exitcode_pipe_fd):
         """ Main entry point.
 
@@ -530,6 +608,9 @@ class Program(object):
 
             # Load configuration
             ret = self.load_configuration()
+            if ret:
+                return ret
+            ret = self.check_configuration()
             if ret:
                 return ret
 
@@ -557,6 +638,7 @@ class Program(object):
             self._handle_uncaught_exception()
 
     def cmd_init(self):
+        self._close_shell_safe()
         if (os.path.exists(self.safe_path) and not self.args.force):
             print('%s exists.  Use -f to override.' % self.safe_path)
             return -10
@@ -660,6 +742,8 @@ class Program(object):
                                  precomputed_gp=self.args.precomputed_gp,
                                  use_threads=self.args.threads,
                                  n_blocks=self.args.blocks) as safe:
+                safe.format = self.config.get('safe-format',
+                                              pol.safe.FORMAT_MSGPACK)
                 for i, mlapw in enumerate(pws):
                     mpw, lpw, apw = mlapw
                     print('  allocating container #%s ...' % (i+1))
@@ -676,16 +760,29 @@ class Program(object):
         with self._open_safe() as safe:
             safe.touch()
 
+    def cmd_convert(self):
+        with self._open_safe() as safe:
+            if safe.format == self.args.to:
+                print('The safe is already in the %s format.' % self.args.to)
+                return
+            safe.format = self.args.to
+            safe.touch()
+
     def cmd_raw(self):
         with self._open_safe() as safe:
+            # The blocks changed in memory are written to `data' lazily.
+            safe.sync_blocks()
             d = dict(safe.data)
             if not self.args.blocks:
                 del d[b'blocks']
+            else:
+                d[b'blocks'] = list(d[b'blocks'])
             pprint.pprint(d)
             if not self.args.passwords:
                 return
-            for password in self.args.passwords:
-                for container in self._open_containers(safe, password):
+            for containers in self._open_containers_many(safe,
+                                                    self.args.passwords):
+                for container in containers:
                     print()
                     print('Container %s' % container.id)
                     if container.main_data:
@@ -696,7 +793,7 @@ class Program(object):
                         pprint.pprint(container.secret_data)
 
     def cmd_get(self):
-        with self._open_safe() as safe:
+        with self._open_safe(agent=True) as safe:
             found_one = False
             entries = []
             for container in self._open_containers(safe,
@@ -785,7 +882,7 @@ class Program(object):
             print('Clipboard access not available.')
             print('Use `pol get\' to print secrets.')
             return -7
-        with self._open_safe() as safe:
+        with self._open_safe(agent=True) as safe:
             found_one = False
             entries = []
             for container in self._open_containers(safe,
@@ -850,7 +947,7 @@ class Program(object):
     def _store(self, pw):
         """ Common code of `pol put', `pol generate' and `pol paste' -
             stores `pw' to an entry self.args.key. """
-        with self._open_safe() as safe:
+        with self._open_safe(agent=True) as safe:
             found_one = False
             stored = False
             for container in self._open_containers(safe,
@@ -906,7 +1003,7 @@ class Program(object):
             return
         found_one = False
         stored = False
-        with self._open_safe() as safe:
+        with self._open_safe(agent=True) as safe:
             for container in self._open_containers(safe,
                     self.args.password if self.args.password
                         else pol.terminal.getpass('Enter (append-)password: ')):
@@ -975,8 +1072,9 @@ class Program(object):
             secrets = {}
             containers = {}
             entries = {}
-            for password in passwords:
-                for container in self._open_containers(safe, password):
+            for password_containers in self._open_containers_many(safe,
+                                                                passwords):
+                for container in password_containers:
                     if not container.has_secrets:
                         continue
                     editfile[container_id] = []
@@ -1047,7 +1145,7 @@ class Program(object):
                 return -16
         else:
             regex = None
-        with self._open_safe() as safe:
+        with self._open_safe(agent=True) as safe:
             found_one = False
             for container in self._open_containers(safe,
                     self.args.password if self.args.password
@@ -1229,33 +1327,136 @@ class Program(object):
     def cmd_shell(self):
         with demandimport.disabled():
             import readline
-        # TODO a more stateful shell would be nice: then we only have to
-        #       ask for the password and rerandomize once.
+        # The safe is opened by the first command that needs it and kept
+        # open.  It is only rerandomized and stored on `save', when the
+        # shell has been idle for `shell-idle-timeout' seconds or on exit.
         if not os.path.exists(self.safe_path):
             print("No safe found.  Type `init' to create a new safe.")
         self.do_not_exit_when_closing_safe = True
-        while True:
-            try:
-                line = input('pol> ').strip()
-            except EOFError:
-                sys.stderr.write("\n")
-                break
-            except KeyboardInterrupt:
-                sys.stderr.write("\nUse C-d to quit.\n")
-                continue
-            if not line:
-                continue
-            argv = shlex.split(line)
+        self.in_shell = True
+        idle_timeout = self.config.get('shell-idle-timeout',
+                                       DEFAULT_SHELL_IDLE_TIMEOUT)
+        if not hasattr(signal, 'SIGALRM'):
+            idle_timeout = None
+        if idle_timeout:
+            def on_alarm(signum, frame):
+                raise Program._ShellIdleTimeout
+            old_handler = signal.signal(signal.SIGALRM, on_alarm)
+        self._start_ks_cache()
+        try:
+            while True:
+                try:
+                    if idle_timeout and self.shell_safe is not None:
+                        signal.alarm(int(math.ceil(idle_timeout)))
+                    try:
+                        line = input('pol> ').strip()
+                    finally:
+                        if idle_timeout:
+                            signal.alarm(0)
+                except EOFError:
+                    sys.stderr.write("\n")
+                    break
+                except KeyboardInterrupt:
+                    sys.stderr.write("\nUse C-d to quit.\n")
+                    continue
+                except Program._ShellIdleTimeout:
+                    sys.stderr.write("\nIdle for %s seconds: closing safe.\n"
+                                            % idle_timeout)
+                    self._run_command(self._close_shell_safe)
+                    continue
+                if not line:
+                    continue
+                argv = shlex.split(line)
+                try:
+                    self.parse_args(argv)
+                except SystemExit:
+                    continue
+                if self.args.func == self.cmd_shell:
+                    continue
+                self._run_command()
+        finally:
             try:
-                self.parse_args(argv)
-            except SystemExit:
-                continue
-            if self.args.func == self.cmd_shell:
-                continue
-            self._run_command()
+                self._run_command(self._close_shell_safe)
+            finally:
+                if idle_timeout:
+                    signal.signal(signal.SIGALRM, old_handler)
+                self.in_shell = False
+                self._stop_ks_cache()
+
+    def cmd_save(self):
+        if not self.in_shell:
+            print("Outside of `pol shell', the safe is saved after every "+
+                  "command.")
+            return
+        if self.shell_safe is None:
+            print("The safe is not open.")
+            return
+        pol.safe.save(self.shell_safe, os.path.expanduser(self.safe_path),
+                      nworkers=self.args.workers,
+                      use_threads=self.args.threads,
+                      rerandomize_fraction=self.config.get(
+                                            'rerandomize-fraction'),
+                      progress=Program._RerandProgress(self))
+
+    def cmd_agent(self):
+        if self.args.stop:
+            client = pol.agent.Client.from_environment()
+            if client is None:
+                sys.stderr.write("No agent found.\n")
+                return -21
+            with contextlib.closing(client):
+                client.stop()
+            print('unset %s;' % pol.agent.SOCKET_ENV_VAR)
+            return
+        path = self.args.socket
+        socket_dir = None
+        if not path:
+            socket_dir = tempfile.mkdtemp(prefix='pol-')
+            path = os.path.join(socket_dir, 'agent.sock')
+        # The agent is no use if it has to stretch every password again.
+        self.ks_cache = pol.ks.KeyStretchingCache(self.config.get(
+                    'ks-cache-timeout', DEFAULT_AGENT_KS_CACHE_TIMEOUT))
+        try:
+            with self._load_safe() as safe:
+                safe.start_factor_pool()
+                agent = pol.agent.Agent(safe, path,
+                        functools.partial(pol.safe.save, safe,
+                                os.path.expanduser(self.safe_path),
+                                nworkers=self.args.workers,
+                                use_threads=self.args.threads,
+                                rerandomize_fraction=self.config.get(
+                                            'rerandomize-fraction')),
+                        self.config.get('agent-save-interval',
+                                        DEFAULT_AGENT_SAVE_INTERVAL),
+                        safe_path=os.path.expanduser(self.safe_path))
+                agent.bind()
+                print('%s=%s; export %s;' % (pol.agent.SOCKET_ENV_VAR, path,
+                                              pol.agent.SOCKET_ENV_VAR))
+                sys.stdout.flush()
+                signal.signal(signal.SIGTERM, lambda signum, frame:
+                                                    agent.stop())
+                signal.signal(signal.SIGHUP, lambda signum, frame:
+                                                    agent.stop())
+                self._go_into_background()
+                if self.in_background:
+                    # Like a daemon, we let go of the terminal, such that
+                    # `eval $(pol agent)' returns.
+                    devnull = os.open(os.devnull, os.O_RDWR)
+                    for fd in range(3):
+                        os.dup2(devnull, fd)
+                    os.close(devnull)
+                agent.serve()
+        finally:
+            self._stop_ks_cache()
+            if socket_dir is not None:
+                shutil.rmtree(socket_dir, ignore_errors=True)
 
     def cmd_vi(self):
-        pol.vi.main(self)
+        self._start_ks_cache()
+        try:
+            pol.vi.main(self)
+        finally:
+            self._stop_ks_cache()
 
     def cmd_export(self):
         close_f = False
@@ -1297,14 +1498,76 @@ class Program(object):
         sys.stderr.write("  moved entries into container: %s\n" % (
                 pol.humanize.join([entry[0] for entry in entries])))
     @contextlib.contextmanager
-    def _open_safe(self):
+    def _open_safe(self, agent=False):
+        """ Opens the safe.  If `agent' is set and a `pol agent' is
+            running for this safe, yields a pol.agent.Client instead, which
+            supports only opening containers and listing, getting and
+            adding entries. """
+        client = pol.agent.Client.from_environment() if agent else None
+        if client is not None and client.safe_path() != os.path.realpath(
+                                        os.path.expanduser(self.safe_path)):
+            # The agent serves another safe
+            client.close()
+            client = None
+        if client is not None:
+            with contextlib.closing(client):
+                yield client
+            return
+        if self.in_shell:
+            yield self._open_shell_safe()
+            return
+        with self._load_safe() as safe:
+            yield safe
+            if not self.do_not_exit_when_closing_safe:
+                self._go_into_background()
+
+    @contextlib.contextmanager
+    def _load_safe(self):
         with pol.safe.open(os.path.expanduser(self.safe_path),
                            nworkers=self.args.workers,
                            use_threads=self.args.threads,
+                           rerandomize_fraction=self.config.get(
+                                            'rerandomize-fraction'),
                            progress=Program._RerandProgress(self)) as safe:
+            safe.ks_cache = self.ks_cache
             yield safe
-            if not self.do_not_exit_when_closing_safe:
-                self._go_into_background()
+
+    def _open_shell_safe(self):
+        """ Returns the safe kept open by the shell, opening it if it
+            is not yet. """
+        if self.shell_safe is None:
+            stack = contextlib.ExitStack()
+            self.shell_safe = stack.enter_context(self._load_safe())
+            self._shell_safe_stack = stack
+            self.shell_session = pol.session.Session(self.shell_safe)
+            # Prepare for the rerandomization, while the user types.
+            self.shell_safe.start_factor_pool()
+        return self.shell_safe
+
+    def _close_shell_safe(self):
+        """ Rerandomizes, stores and closes the safe kept open by the
+            shell, if any. """
+        if self.shell_safe is None:
+            return
+        stack = self._shell_safe_stack
+        self.shell_safe = None
+        self.shell_session = None
+        self._shell_safe_stack = None
+        stack.close()
+
+
+    def _start_ks_cache(self):
+        """ Starts to cache stretched passwords, if `ks-cache-timeout' is
+            set in the configuration.  Used by long-lived sessions. """
+        timeout = self.config.get('ks-cache-timeout')
+        if timeout:
+            self.ks_cache = pol.ks.KeyStretchingCache(timeout)
+
+    def _stop_ks_cache(self):
+        """ Wipes the cached stretched passwords, if any. """
+        if self.ks_cache is not None:
+            self.ks_cache.clear()
+            self.ks_cache = None
 
     def _go_into_background(self):
         """ Tells the parent-process (if any) to exit.  This will return
@@ -1315,15 +1578,20 @@ class Program(object):
             os.write(self.exitcode_pipe_fd, b'\0')
             self.exitcode_pipe_fd = None
 
-    def _run_command(self):
+    def _run_command(self, func=None):
+        """ Runs `func' (by default: the command parsed) and handles
+            common errors. """
         try:
-            return self.args.func()
+            return (func or self.args.func)()
         except pol.safe.SafeNotFoundError:
             sys.stderr.write("%s: no such file.\n" % self.safe_path)
             sys.stderr.write("To create a new safe, run `pol init'.\n")
             return -5
         except pol.safe.SafeLocked:
             sys.stderr.write("%s: locked.\n" % self.safe_path)
+            if os.environ.get(pol.agent.SOCKET_ENV_VAR):
+                sys.stderr.write("Use `pol agent --stop' to stop the "+
+                                 "agent that keeps it open.\n")
             # TODO add a `pol break-lock'
             return -6
         except pol.safe.WrongMagicError:
@@ -1353,7 +1621,24 @@ class Program(object):
         if isinstance(password, str):
             password = password.encode('utf-8')
         self._ensure_keyfiles_are_loaded()
-        return safe.open_containers(password,
+        # The shell keeps the containers it opens in a session.
+        open_containers = (self.shell_session.open_containers
+                                if safe is self.shell_safe
+                                else safe.open_containers)
+        return open_containers(password,
+                        on_move_append_entries=self._on_move_append_entries,
+                        additional_keys=self.additional_keys)
+
+    def _open_containers_many(self, safe, passwords):
+        """ Like `_open_containers', but for several passwords at once:
+            returns for each password the list of containers it opened. """
+        passwords = [password.encode('utf-8') if isinstance(password, str)
+                        else password for password in passwords]
+        self._ensure_keyfiles_are_loaded()
+        open_containers_many = (self.shell_session.open_containers_many
+                                    if safe is self.shell_safe
+                                    else safe.open_containers_many)
+        return open_containers_many(passwords,
                         on_move_append_entries=self._on_move_append_entries,
                         additional_keys=self.additional_keys)
 
@@ -1369,6 +1654,9 @@ class Program(object):
         sys.stderr.write("\n")
         sys.stderr.flush()
 
+    class _ShellIdleTimeout(Exception):
+        """ Raised when the shell has been idle for too long. """
+
     class _RerandProgress():
         """ Glue between callbacks of rerandomize and the progressbar. """
         def __init__(self, program):
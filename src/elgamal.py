@@ -93,6 +93,13 @@ PRECOMPUTED_GROUP_PARAMS = {
             '05523817cb087debb711289e28db4fd35da61ad6e4c39106e01']
         }
 
+# Size in bits of the windows of a FixedBaseTable
+FIXED_BASE_WINDOW = 6
+
+# Caches the FixedBaseTable per group parameters.  See `fixed_base_table'.
+_fixed_base_tables = {}
+_fixed_base_tables_lock = threading.Lock()
+
 if not number._fastmath:
     l.warning("pycrypto not built with _fastmath module.  A lot will be quite "+
               "slow")
@@ -159,8 +166,72 @@ def generate_group_params(bits=1025, nworkers=None, use_threads=False,
     l.debug('Found one in %.2fs', time.time() - start_time)
     return group_parameters(p=p, g=g)
 
+class FixedBaseTable(object):
+    """ Precomputed powers of a fixed base `g' modulo `p' to quickly
+        compute g^x mod p for many different exponents x.
+
+        The exponent is split into windows of `window' bits.  The i-th
+        row of the table contains g^(j * 2^(i*window)) for every j
+        in a window.  Thus g^x is the product of one entry of each row.
+
+        Which entries are read depends on the bits of x, which may leak
+        through the cache.  Only use it for exponents that are public or
+        random and used once, not for private keys. """
+
+    def __init__(self, g, p, bits, window=FIXED_BASE_WINDOW):
+        start_time = time.time()
+        self.g = g
+        self.p = p
+        self.bits = bits
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.rows = []
+        base = gmpy2.mpz(g)
+        for i in range((bits + window - 1) // window):
+            row = [gmpy2.mpz(1)]
+            for j in range(self.mask):
+                row.append((row[-1] * base) % p)
+            self.rows.append(row)
+            base = (row[-1] * base) % p
+        l.debug('Built fixed-base table for %s bit exponents in %.2fs',
+                    bits, time.time() - start_time)
+
+    def pow(self, x):
+        """ Returns g^x mod p """
+        if x < 0 or x.bit_length() > self.bits:
+            return pow(self.g, x, self.p)
+        ret = gmpy2.mpz(1)
+        for row in self.rows:
+            if not x:
+                break
+            digit = x & self.mask
+            if digit:
+                ret = (ret * row[digit]) % self.p
+            x >>= self.window
+        return ret
+
+def fixed_base_table(gp):
+    """ Returns the FixedBaseTable for the generator of the group
+        parameters `gp'.  It is created on first use. """
+    key = (gp.g, gp.p)
+    table = _fixed_base_tables.get(key)
+    if table is None:
+        with _fixed_base_tables_lock:
+            table = _fixed_base_tables.get(key)
+            if table is None:
+                table = FixedBaseTable(gmpy2.mpz(gp.g), gmpy2.mpz(gp.p),
+                                       gmpy2.mpz(gp.p).bit_length())
+                _fixed_base_tables[key] = table
+    return table
+
+def pow_g(x, gp):
+    """ Returns g^x mod p for group parameters `gp'.  See FixedBaseTable
+        for which exponents `x' this may be used. """
+    return fixed_base_table(gp).pow(gmpy2.mpz(x))
+
 def pubkey_from_privkey(privkey, gp):
-    return pow(gp.g, privkey, gp.p)
+    # Not pow_g: its table lookups depend on the private key.
+    return gmpy2.powmod(gp.g, privkey, gp.p)
 def string_to_group(s):
     return pol.serialization.string_to_number(s)
 def group_to_string(n, size):
@@ -173,7 +244,7 @@ def encrypt(string, pubkey, gp, size, randfunc):
     # TODO how small may size be?
     number = string_to_group(string)
     r = string_to_group(randfunc(size))
-    c1 = pow(gp.g, r, gp.p)
+    c1 = pow_g(r, gp)
     s = pow(pubkey, r, gp.p)
     c2 = (number * s) % gp.p
     return (c1, c2)
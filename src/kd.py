@@ -44,6 +44,11 @@ class KeyDerivation(object):
         """ Derives a key of `length' bytes from the list of strings `args'. """
         raise NotImplementedError
 
+    def derive_many(self, prefix, suffixes, length=32):
+        """ Returns the list of derived keys of `length' bytes for the
+            lists of strings `prefix + [suffix]' for suffix in `suffixes'. """
+        return [self.derive(prefix + [suffix], length) for suffix in suffixes]
+
     @property
     def size(self):
         """ The "natural" size of the key-derivation """
@@ -91,6 +96,39 @@ class SHAKeyDerivation(KeyDerivation):
             ret += self._derive(args + [self.word_struct.pack(i), self.salt])
         return ret[:length]
 
+    def derive_many(self, prefix, suffixes, length=32):
+        # The hashes of `prefix', of the counter words and of the salt
+        # are the same for every suffix.  We compute them only once.
+        if self.bits == 256:
+            new_hash = hashlib.sha256
+        else:
+            assert False
+        byts = self.bits // 8
+        n = length // byts
+        if length % byts != 0:
+            n += 1
+        salt_hash = new_hash(self.salt).digest()
+        tails = [new_hash(self.word_struct.pack(i)).digest() + salt_hash
+                    for i in range(n)]
+        head = new_hash()
+        for arg in prefix:
+            if not isinstance(arg, bytes):
+                raise TypeError("`prefix' should be a list of strings")
+            head.update(new_hash(arg).digest())
+        ret = []
+        for suffix in suffixes:
+            if not isinstance(suffix, bytes):
+                raise TypeError("`suffixes' should be a list of strings")
+            h = head.copy()
+            h.update(new_hash(suffix).digest())
+            key = b''
+            for tail in tails:
+                oh = h.copy()
+                oh.update(tail)
+                key += oh.digest()
+            ret.append(key[:length])
+        return ret
+
     @property
     def size(self):
         return self.bits // 8
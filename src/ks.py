@@ -1,9 +1,15 @@
 """ Implementation of key stretching  """
 
+import hmac
+import time
+import hashlib
 import logging
+import threading
 
 import Crypto.Random
 
+import msgpack
+
 import scrypt
 
 import argon2 # argon2-cffi
@@ -122,5 +128,74 @@ class Argon2KeyStretching(KeyStretching):
                             version=self.params[b'v'],
                             type=argon2.low_level.Type.D)
 
+class KeyStretchingCache(object):
+    """ Remembers the stretched keys of passwords for `timeout' seconds,
+        such that a long-lived session, like `pol shell', does not have to
+        stretch the same password twice.
+
+        The cache is only kept in memory.  It is indexed by a HMAC, with
+        a random key, of the parameters of the key-stretching and the
+        password.  Keys are dropped when they expire or on `clear'.  They
+        are not overwritten: Python may have copied them elsewhere, so it
+        cannot make such a promise. """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._hmac_key = Crypto.Random.new().read(32)
+        # maps HMAC to (time of expiry, stretched key)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def stretch(self, ks, password):
+        """ Returns ks.stretch(password), from the cache if possible. """
+        index = hmac.new(self._hmac_key,
+                         msgpack.packb(ks.params, use_bin_type=True)
+                            + password,
+                         hashlib.sha256).digest()
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(index)
+            if entry is not None:
+                return entry[1]
+        key = ks.stretch(password)
+        with self._lock:
+            self._entries[index] = (time.monotonic() + self.timeout, key)
+            self._schedule()
+        return key
+
+    def clear(self):
+        """ Forgets all stretched keys. """
+        with self._lock:
+            self._entries.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self):
+        now = time.monotonic()
+        for index, (expiry, key) in list(self._entries.items()):
+            if expiry <= now:
+                del self._entries[index]
+
+    def _schedule(self):
+        """ Starts a timer to drop the first key to expire. """
+        if self._timer is not None or not self._entries:
+            return
+        delay = min(expiry for expiry, key in self._entries.values()) \
+                    - time.monotonic()
+        self._timer = threading.Timer(max(0, delay), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._expire()
+            self._schedule()
+
 TYPE_MAP = {b'scrypt': ScryptKeyStretching,
             b'argon2': Argon2KeyStretching}
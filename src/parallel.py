@@ -1,10 +1,34 @@
 """ Extensions to Python's multiprocessing. """
 
+import io
+import math
 import time
 import queue
+import atexit
+import pickle
+import weakref
 import threading
 import multiprocessing
 
+import demandimport
+
+# multiprocessing.shared_memory is new in Python 3.8.
+have_shared_memory = False
+try:
+    with demandimport.disabled():
+        from multiprocessing import shared_memory, resource_tracker
+    have_shared_memory = True
+except ImportError:
+    pass
+
+# Rough estimates, in seconds, of the time it takes to start a worker and
+# the time it takes to hand a chunk to a worker and get the result back.
+# Used to pick chunk sizes if none is given.
+PROCESS_START_OVERHEAD = 0.005
+THREAD_START_OVERHEAD = 0.0005
+PROCESS_CHUNK_OVERHEAD = 0.0002
+THREAD_CHUNK_OVERHEAD = 0.00003
+
 def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
                         nworkers=None, progress=None, progress_interval=0.1,
                         initializer=None, use_threads=False):
@@ -16,50 +40,83 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
 
             [f(x, *args, **kwargs) for x in seq]
 
+        An exception raised by `func' or `initializer' in a worker is
+        raised again.
+
             `nworkers`  number of workers to spawn
             `chunk_size`    number of elements to hand to a thread at the
-                        same time.
+                        same time.  If None, the chunk sizes are picked
+                        based on the time it takes to map an element,
+                        see `_plan_chunks`.
             `progress`  a function to periodically call with the number of
                         elements of seq already mapped
             `progress_interval`     the approximate time interval to call
                         the `progress` function
             `initializer`           called in each worker process when spawn,
                         with (args, kwargs) as arguments.  `initializer`
-                        may change args, kwargs.
+                        may change kwargs: each worker has its own copy.
             `use_threads`   specifies to use threads instead of processes. """
-    # Shortcut for when there is only one chunk:
     if args is None:
         args = ()
     if kwargs is None:
         kwargs = {}
-    if len(seq) <= chunk_size:
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    if chunk_size is None:
+        ret, chunks = _plan_chunks(func, seq, args, kwargs, initializer,
+                nworkers, nworkers * (THREAD_START_OVERHEAD if use_threads
+                                            else PROCESS_START_OVERHEAD),
+                THREAD_CHUNK_OVERHEAD if use_threads
+                                else PROCESS_CHUNK_OVERHEAD)
+        if not chunks:
+            return ret
+    elif len(seq) <= chunk_size:
+        # Shortcut for when there is only one chunk
         if initializer is not None:
+            kwargs = dict(kwargs)
             initializer(args, kwargs)
         return  [func(x, *args, **kwargs) for x in seq]
+    else:
+        ret = []
+        chunks = [(i, min(chunk_size, len(seq) - i))
+                        for i in range(0, len(seq), chunk_size)]
     # We got more than one chunk --- we will need workers:
     def worker(c_func, c_args, c_kwargs, c_input, c_output, c_initializer):
         try:
+            # An exception is passed on with every chunk this worker
+            # takes, such that the caller does not wait for them forever.
+            error = None
             if c_initializer is not None:
-                c_initializer(c_args, c_kwargs)
+                # Threads share `c_kwargs': each gets its own copy.
+                c_kwargs = dict(c_kwargs)
+                try:
+                    c_initializer(c_args, c_kwargs)
+                except Exception as e:
+                    error = _picklable_error(e)
             while True:
                 p = c_input.get()
                 if p is None:
                     break
                 i, xs = p
-                ys = []
-                for x in xs:
-                    ys.append(c_func(x, *c_args, **c_kwargs))
-                c_output.put((i, ys))
+                if error is None:
+                    try:
+                        ys = [c_func(x, *c_args, **c_kwargs) for x in xs]
+                    except Exception as e:
+                        c_output.put((i, None, _picklable_error(e)))
+                        continue
+                    c_output.put((i, ys, None))
+                else:
+                    c_output.put((i, None, error))
         except KeyboardInterrupt:
             pass
-    if nworkers is None:
-        nworkers = multiprocessing.cpu_count()
     p_input = multiprocessing.Queue()
     p_output = multiprocessing.Queue()
     processes = []
     N = len(seq)
-    n = 0
-    ret = [None]*N
+    n = len(ret)
+    ret.extend([None]*(N - n))
+    chunk_sizes = dict(chunks)
+    error = None
     constr = threading.Thread if use_threads else multiprocessing.Process
     try:
         for i in range(nworkers):
@@ -68,8 +125,8 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
             processes.append(process)
             process.start()
         # Add the elements to be mapped to the queue
-        for i in range(0, N, chunk_size):
-            p_output.put((i, seq[i:i+chunk_size]))
+        for i, size in chunks:
+            p_output.put((i, seq[i:i+size]))
         # and after that sentinels to signal the end
         # of the queue, one for each worker
         for i in range(nworkers):
@@ -77,7 +134,12 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
         next_update = (time.time() + progress_interval
                             if progress else float('inf'))
         while n < N:
-            i, ys = p_input.get()
+            i, ys, chunk_error = p_input.get()
+            if chunk_error is not None:
+                if error is None:
+                    error = chunk_error
+                n += chunk_sizes[i]
+                continue
             ret[i:i+len(ys)] = ys
             n += len(ys)
             if time.time() > next_update:
@@ -87,8 +149,60 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
         for process in processes:
             process.terminate()
         raise
+    if error is not None:
+        raise error
     return ret
 
+def _plan_chunks(func, seq, args, kwargs, initializer, nworkers,
+                    start_overhead, chunk_overhead):
+    """ Maps `func' over the first elements of `seq' to measure the
+        time it takes per element.  The first is not timed, as it may pay
+        for one-time setup, like building tables or importing modules.  If
+        the second seems slow enough to start the workers, the third is
+        timed as well and the fastest of the two counts.  Returns
+        (ys, chunks) where `ys' are the elements mapped so far and `chunks'
+        are (offset, size) pairs of the elements left for the workers.
+
+        If the work left is too little to make up for `start_overhead',
+        the time to start the workers, everything is mapped here.
+        Otherwise the chunks get smaller towards the end of `seq' (guided
+        scheduling), such that the workers, which take chunks as they
+        are done with the previous one, finish at about the same time. """
+    N = len(seq)
+    if N == 0:
+        return [], []
+    l_kwargs = dict(kwargs)
+    if initializer is not None:
+        initializer(args, l_kwargs)
+    ys = [func(seq[0], *args, **l_kwargs)]
+    if N == 1:
+        return ys, []
+    def time_one(i):
+        start_time = time.time()
+        ys.append(func(seq[i], *args, **l_kwargs))
+        return time.time() - start_time
+    def worth_starting(item_time, n_left):
+        return nworkers > 1 and (item_time * n_left * (1 - 1.0 / nworkers)
+                            > start_overhead + chunk_overhead * nworkers)
+    item_time = time_one(1)
+    i = 2
+    # A single measurement might include a context switch.  Before we start
+    # workers on it, we measure another element.
+    if N > 2 and worth_starting(item_time, N - 2):
+        item_time = min(item_time, time_one(2))
+        i = 3
+    if not worth_starting(item_time, N - i):
+        ys.extend(func(x, *args, **l_kwargs) for x in seq[i:])
+        return ys, []
+    # A chunk should take longer to map than to hand to a worker.
+    min_size = max(1, int(math.ceil(chunk_overhead / max(item_time, 1e-6))))
+    chunks = []
+    while i < N:
+        size = min(N - i, max(min_size, (N - i) // (2 * nworkers)))
+        chunks.append((i, size))
+        i += size
+    return ys, chunks
+
 def parallel_try(func, args=None, kwargs=None, nworkers=None, progress=None,
                         progress_interval=0.1, update_interval=0.05,
                         initializer=None, join=True, use_threads=False):
@@ -109,13 +223,15 @@ def parallel_try(func, args=None, kwargs=None, nworkers=None, progress=None,
                         (if `join` is True)
             `initializer`           called in each worker process when spawn,
                         with (args, kwargs) as arguments.  `initializer`
-                        may change args, kwargs.
+                        may change kwargs: each worker has its own copy.
             `join`      specifies whether to wait for all threads to finish
             `use_threads`   specifies to use threads instead of processes. """
     def worker(c_func, c_args, c_kwargs, c_lock, c_done, c_output, c_counter,
                         c_initializer):
         try:
             if c_initializer is not None:
+                # Threads share `c_kwargs': each gets its own copy.
+                c_kwargs = dict(c_kwargs)
                 c_initializer(c_args, c_kwargs)
             last_update = time.time()
             iterations = 0
@@ -172,3 +288,291 @@ def parallel_try(func, args=None, kwargs=None, nworkers=None, progress=None,
             process.terminate()
         raise
     return p_input.get()
+
+class WorkerPoolClosedError(Exception):
+    pass
+
+# The pools with workers, which we close when Python exits: otherwise
+# exiting might wait for the workers forever.
+_pools_with_workers = weakref.WeakSet()
+
+@atexit.register
+def _close_pools_with_workers():
+    for pool in list(_pools_with_workers):
+        pool.close()
+
+class WorkerPool(object):
+    """ A pool of long-lived workers, which are reused by `map'.
+
+        Contrary to `parallel_map', the workers are only spawned on the
+        first call to `map' and not on every call.  For process workers
+        the function, its arguments and initializer are pickled with every
+        call.  The objects in `shared' are not pickled: each process
+        worker uses the copy it got when it was forked.  Call `invalidate'
+        when these objects change: the process workers are then replaced
+        on the next call to `map'.  If other threads change the objects
+        in `shared', they should hold `fork_lock' while they do: it is held
+        while the process workers are forked.  If given, `on_fork' is
+        called right before, with `fork_lock' held. """
+
+    def __init__(self, nworkers=None, use_threads=False, shared=(),
+                    fork_lock=None, on_fork=None):
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        self.nworkers = nworkers
+        self.use_threads = use_threads
+        self.shared = tuple(shared)
+        self.fork_lock = fork_lock
+        self.on_fork = on_fork
+        self.lock = threading.Lock()
+        self.workers = []
+        self.closed = False
+        self.stale = False
+        self.job_id = 0
+        self.p_input = None
+        self.p_output = None
+
+    def invalidate(self):
+        """ Signals that the objects in `shared' have changed. """
+        if not self.use_threads:
+            self.stale = True
+
+    def map(self, func, seq, args=None, kwargs=None, chunk_size=1,
+                progress=None, progress_interval=0.1, initializer=None):
+        """ Similar to `parallel_map', but on the workers of this pool.
+            An exception raised by `func' or `initializer' in a worker
+            is raised again. """
+        if self.closed:
+            raise WorkerPoolClosedError
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        if chunk_size is None:
+            if self.use_threads:
+                start_overhead = THREAD_START_OVERHEAD
+                chunk_overhead = THREAD_CHUNK_OVERHEAD
+            else:
+                start_overhead = PROCESS_START_OVERHEAD
+                chunk_overhead = PROCESS_CHUNK_OVERHEAD
+            if self.workers and not self.stale:
+                start_overhead = 0
+            else:
+                start_overhead *= self.nworkers
+            ys, chunks = _plan_chunks(func, seq, args, kwargs, initializer,
+                            self.nworkers, start_overhead, chunk_overhead)
+            if not chunks:
+                return ys
+        elif len(seq) <= chunk_size:
+            # Shortcut for when there is only one chunk
+            if initializer is not None:
+                kwargs = dict(kwargs)
+                initializer(args, kwargs)
+            return [func(x, *args, **kwargs) for x in seq]
+        else:
+            ys = []
+            chunks = [(i, min(chunk_size, len(seq) - i))
+                            for i in range(0, len(seq), chunk_size)]
+        with self.lock:
+            if self.closed:
+                raise WorkerPoolClosedError
+            if self.stale:
+                self._stop_workers()
+            if not self.workers:
+                self._start_workers()
+            try:
+                return self._map(func, seq, args, kwargs, ys, chunks,
+                                    progress, progress_interval, initializer)
+            except KeyboardInterrupt:
+                self._stop_workers(terminate=True)
+                raise
+
+    def _map(self, func, seq, args, kwargs, ys, chunks, progress,
+                    progress_interval, initializer):
+        self.job_id += 1
+        job = (func, args, kwargs, initializer)
+        if not self.use_threads:
+            job = _dumps_with_shared(job, self.shared)
+        N = len(seq)
+        n = len(ys)
+        ret = ys + [None]*(N - n)
+        chunk_sizes = dict(chunks)
+        error = None
+        for i, size in chunks:
+            self.p_input.put((self.job_id, job, i, seq[i:i+size]))
+        next_update = (time.time() + progress_interval
+                            if progress else float('inf'))
+        while n < N:
+            try:
+                job_id, i, ys, chunk_error = self.p_output.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    self._stop_workers(terminate=True)
+                    raise RuntimeError("a worker died unexpectedly")
+                continue
+            if job_id != self.job_id:
+                continue
+            if chunk_error is not None:
+                # We continue to collect the other chunks of this job,
+                # such that they do not end up in the next job.
+                if error is None:
+                    error = chunk_error
+                n += chunk_sizes[i]
+                continue
+            ret[i:i+len(ys)] = ys
+            n += len(ys)
+            if time.time() > next_update:
+                next_update = time.time() + progress_interval
+                progress(n)
+        if error is not None:
+            raise error
+        return ret
+
+    def _start_workers(self):
+        if self.use_threads:
+            self.p_input = queue.Queue()
+            self.p_output = queue.Queue()
+            constr = threading.Thread
+        else:
+            self.p_input = multiprocessing.Queue()
+            self.p_output = multiprocessing.Queue()
+            constr = multiprocessing.Process
+            if have_shared_memory:
+                # Otherwise each worker that attaches to a SharedBuffer
+                # starts its own resource tracker, which would complain
+                # about leaked shared memory when the worker exits.
+                resource_tracker.ensure_running()
+        if self.fork_lock is not None and not self.use_threads:
+            self.fork_lock.acquire()
+        try:
+            if self.on_fork is not None and not self.use_threads:
+                self.on_fork()
+            for i in range(self.nworkers):
+                worker = constr(target=_worker_pool_main,
+                                args=(self.p_input, self.p_output,
+                                        self.shared, self.use_threads))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            if self.fork_lock is not None and not self.use_threads:
+                self.fork_lock.release()
+        _pools_with_workers.add(self)
+        self.stale = False
+
+    def _stop_workers(self, terminate=False):
+        if not terminate:
+            for worker in self.workers:
+                self.p_input.put(None)
+        for worker in self.workers:
+            if terminate and not self.use_threads:
+                worker.terminate()
+            worker.join()
+        self.workers = []
+        self.p_input = None
+        self.p_output = None
+
+    def close(self):
+        """ Stops the workers. """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.workers:
+                self._stop_workers()
+
+def _worker_pool_main(c_input, c_output, c_shared, c_use_threads):
+    current_job_id = None
+    try:
+        while True:
+            p = c_input.get()
+            if p is None:
+                break
+            job_id, job, i, xs = p
+            try:
+                if job_id != current_job_id:
+                    current_job_id = None
+                    if not c_use_threads:
+                        job = _loads_with_shared(job, c_shared)
+                    func, args, kwargs, initializer = job
+                    kwargs = dict(kwargs)
+                    if initializer is not None:
+                        initializer(args, kwargs)
+                    current_job_id = job_id
+                ys = [func(x, *args, **kwargs) for x in xs]
+            except Exception as e:
+                if not c_use_threads:
+                    e = _picklable_error(e)
+                c_output.put((job_id, i, None, e))
+                continue
+            c_output.put((job_id, i, ys, None))
+    except KeyboardInterrupt:
+        pass
+
+def _picklable_error(error):
+    """ Returns `error' or, if it does not survive pickling, a
+        RuntimeError that describes it.
+
+        A multiprocessing.Queue pickles in a background thread.  If that
+        fails, the error is dropped and the receiver waits forever. """
+    try:
+        pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return RuntimeError(repr(error))
+    return error
+
+class _SharedPickler(pickle.Pickler):
+    """ Pickles the objects in `shared' as references. """
+    def __init__(self, f, shared):
+        super(_SharedPickler, self).__init__(f, pickle.HIGHEST_PROTOCOL)
+        self.shared_ids = {id(x): i for i, x in enumerate(shared)}
+    def persistent_id(self, obj):
+        return self.shared_ids.get(id(obj))
+
+class _SharedUnpickler(pickle.Unpickler):
+    """ Resolves the references written by `_SharedPickler'. """
+    def __init__(self, f, shared):
+        super(_SharedUnpickler, self).__init__(f)
+        self.shared = shared
+    def persistent_load(self, pid):
+        return self.shared[pid]
+
+def _dumps_with_shared(obj, shared):
+    f = io.BytesIO()
+    _SharedPickler(f, shared).dump(obj)
+    return f.getvalue()
+
+def _loads_with_shared(data, shared):
+    return _SharedUnpickler(io.BytesIO(data), shared).load()
+
+class SharedBuffer(object):
+    """ A buffer of `size' bytes in shared memory.
+
+        A SharedBuffer is pickled as a reference to the shared memory.  Thus
+        it can be passed to process workers, which can read and write it in
+        place, without copying its contents through a queue.  Requires
+        `have_shared_memory'.  The creator should call `close' and then
+        `unlink' when it is done with it. """
+
+    def __init__(self, size, name=None):
+        self.size = size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=max(1, size))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+    def __reduce__(self):
+        return (SharedBuffer, (self.size, self.shm.name))
+
+    @property
+    def buf(self):
+        """ A memoryview on the buffer.  It has to be released before
+            `close' is called. """
+        return self.shm.buf[:self.size]
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -1,19 +1,28 @@
 """ Implementation of pol safes.  See `Safe`. """
 
+import io
 import os
+import array
+import math
+import mmap
 import shutil
 import time
+import bisect
 import struct
 import logging
 import os.path
 import weakref
+import hashlib
 import binascii
+import threading
 import tempfile
+import functools
 import contextlib
 import collections
 import multiprocessing
 
 import pol.serialization
+import pol.blockstore
 import pol.blockcipher
 import pol.parallel
 import pol.envelope
@@ -29,11 +38,38 @@ import gmpy2
 # TODO Generating random numbers seems CPU-bound.  Does the default random
 #      generator wait for a certain amount of entropy?
 import Crypto.Random
-import Crypto.Random.random as random
 
 l = logging.getLogger(__name__)
 
 SAFE_MAGIC = b'pol\n' + binascii.unhexlify(b'd163d4977a2cf681ad9a6cfe98ab')
+# Magic of the format in which the blocks are stored in a region of
+# fixed-width records after the header.  See doc/FORMAT.md
+SAFE_FIXED_MAGIC = (b'pol\n'
+                        + binascii.unhexlify(b'9b965fb53a6d97bcce6af2fc9a25'))
+
+# The formats in which a safe can be stored.
+FORMAT_MSGPACK = 'msgpack'  # everything in one msgpack object
+FORMAT_FIXED = 'fixed'      # a msgpack header and fixed-width blocks
+FORMATS = (FORMAT_MSGPACK, FORMAT_FIXED)
+
+# In the fixed format, the header is followed by padding such that the
+# blocks start at a multiple of FIXED_ALIGNMENT.
+FIXED_ALIGNMENT = 4096
+_fixed_header_struct = struct.Struct('>II')
+
+# In the msgpack format, the blocks are packed and written in chunks of
+# this many blocks.  See `_pack_blocks'.
+PACK_CHUNK_SIZE = 1024
+
+# If more than this fraction of the blocks changed, a safe in the fixed
+# format is rewritten completely instead of in place.  See `store_to_file'.
+FULL_REWRITE_FRACTION = 0.5
+
+# A journal, stored next to the safe, contains the writes of a change
+# in place to the safe.  See `_write_journal'.
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_MAGIC = binascii.unhexlify(b'3ed8b26f4d1c90a7')
+_journal_entry_struct = struct.Struct('>QI')
 
 class MissingKey(ValueError):
     pass
@@ -72,10 +108,17 @@ def create(path, override=False, *args, **kwargs):
         locked = True
         if os.path.exists(path) and not override:
             raise SafeAlreadyExistsError
+        # A journal left by the safe we override, would otherwise be
+        # replayed onto the new one.
+        if os.path.exists(path + JOURNAL_SUFFIX):
+            os.remove(path + JOURNAL_SUFFIX)
         with _builtin_open(path, 'wb') as f:
             safe = Safe.generate(*args, **kwargs)
-            yield safe
-            safe.store_to_stream(f)
+            try:
+                yield safe
+                safe.store_to_stream(f)
+            finally:
+                safe.close()
     except lockfile.AlreadyLocked:
         raise SafeLocked
     finally:
@@ -86,11 +129,15 @@ _builtin_open = open
 
 @contextlib.contextmanager
 def open(path, readonly=False, progress=None, nworkers=None, use_threads=False,
-                    always_rerandomize=True):
+                    always_rerandomize=True, rerandomize_fraction=None):
     """ Loads a safe from the filesystem.
 
         Contrary to `Safe.load_from_stream', this function also takes care
-        of locking. """
+        of locking.
+
+        If `rerandomize_fraction' is set, only that fraction of the blocks
+        (and the blocks that were changed) is rerandomized when the safe
+        is closed.  See `ElGamalSafe.rerandomize'. """
     # TODO Allow multiple readers.
     locked = False
     try:
@@ -99,24 +146,40 @@ def open(path, readonly=False, progress=None, nworkers=None, use_threads=False,
         locked = True
         if not os.path.exists(path):
             raise SafeNotFoundError
+        _replay_journal(path)
         with _builtin_open(path, 'rb') as f:
             safe = Safe.load_from_stream(f, nworkers, use_threads)
-        yield safe
-        if not readonly:
-            safe.autosave_containers()
-            if safe.touched or always_rerandomize:
-                safe.rerandomize(progress=progress,
-                                 nworkers=nworkers,
-                                 use_threads=use_threads)
-                with tempfile.NamedTemporaryFile(delete=False) as f:
-                    safe.store_to_stream(f)
-                    shutil.move(f.name, path)
+        try:
+            yield safe
+            if not readonly:
+                safe.autosave_containers()
+                if safe.touched or always_rerandomize:
+                    save(safe, path, progress=progress, nworkers=nworkers,
+                         use_threads=use_threads,
+                         rerandomize_fraction=rerandomize_fraction)
+        finally:
+            safe.close()
     except lockfile.AlreadyLocked:
         raise SafeLocked
     finally:
         if locked:
             lock.release()
 
+def save(safe, path, progress=None, nworkers=None, use_threads=False,
+                rerandomize_fraction=None):
+    """ Saves the containers of `safe', rerandomizes it and stores it
+        to `path'.
+
+        This is done automatically when a safe opened with `open' is
+        closed.  Call it to store a safe that is kept open for long. """
+    safe.autosave_containers()
+    safe.rerandomize(progress=progress, nworkers=nworkers,
+                     use_threads=use_threads, fraction=rerandomize_fraction)
+    # Only if a fraction of the blocks is rerandomized, few enough blocks
+    # change to write them in place.
+    safe.store_to_file(path, in_place=rerandomize_fraction is not None)
+    safe.untouch()
+
 class Safe(object):
     """ A pol safe deniably stores containers. (Containers store secrets.) """
 
@@ -138,34 +201,240 @@ class Safe(object):
         self.cipher = pol.blockcipher.BlockCipher.setup(
                             self.data[b'block-cipher'])
         self._touched = False
+        # If set, a pol.ks.KeyStretchingCache used by `_stretch'.
+        self.ks_cache = None
+        # The format in which the safe is stored.  One of FORMATS.
+        # The fixed format is opt-in: releases of pol before 0.5 cannot
+        # open it.
+        self.format = FORMAT_MSGPACK
+        # If the safe has been loaded from (or stored to) a file in the
+        # fixed format, these are the device and inode of that file and
+        # the size reserved for its header.  Together with `_dirty_blocks',
+        # the indices of the blocks changed since, they allow
+        # `store_to_file' to write only the changes.
+        self._fixed_file_id = None
+        self._fixed_header_size = None
+        self._dirty_blocks = set()
 
     def store_to_stream(self, stream):
-        """ Stores the Safe to `stream'.
+        """ Stores the Safe to `stream' in the format `format'.
 
             This is done automatically if opened with `open'. """
+        self.sync_blocks()
         start_time = time.time()
         l.debug('Packing ...')
-        stream.write(SAFE_MAGIC)
-        msgpack.pack(self.data, stream, use_bin_type=True)
+        if self.format == FORMAT_FIXED:
+            self._store_fixed_to_stream(stream)
+        else:
+            stream.write(SAFE_MAGIC)
+            self._store_msgpack_to_stream(stream)
         l.debug(' packed in %.2fs', time.time() - start_time)
 
+    def store_to_file(self, path, in_place=False):
+        """ Stores the Safe to the file `path'.
+
+            If `in_place' is set, the safe was loaded from `path' in the
+            fixed format and only few blocks have changed, only the changed
+            blocks and the header are written.  The changes are first
+            written to a journal, such that they can be completed by `open'
+            after a crash.  Otherwise, the file is replaced in one go.
+
+            This is done automatically if opened with `open', with
+            `in_place' set if only a fraction of the blocks is rerandomized:
+            otherwise all blocks change. """
+        self.sync_blocks()
+        if (in_place and self.format == FORMAT_FIXED
+                and self._fixed_file_id is not None
+                and os.path.exists(path)
+                and _file_id(path) == self._fixed_file_id
+                and len(self._dirty_blocks) <= (FULL_REWRITE_FRACTION
+                                                    * len(self.data[b'blocks']))
+                and self._store_in_place(path)):
+            return
+        with tempfile.NamedTemporaryFile(delete=False,
+                        dir=os.path.dirname(os.path.abspath(path))) as f:
+            self.store_to_stream(f)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.move(f.name, path)
+        if self.format == FORMAT_FIXED:
+            self._fixed_file_id = _file_id(path)
+            self._fixed_header_size = self._packed_fixed_header()[1]
+            self._dirty_blocks = set()
+
+    def _store_in_place(self, path):
+        """ Writes the header and the changed blocks to the file `path',
+            which contains the safe in the fixed format.  Returns False
+            if the header does not fit. """
+        packed_header, header_size = self._packed_fixed_header()
+        if header_size > self._fixed_header_size:
+            return False
+        header_size = self._fixed_header_size
+        blocks = self.data[b'blocks']
+        region = blocks.region()
+        region_offset = (len(SAFE_FIXED_MAGIC) + _fixed_header_struct.size
+                            + header_size)
+        entries = [(len(SAFE_FIXED_MAGIC),
+                    _fixed_header_struct.pack(header_size, len(packed_header))
+                        + packed_header.ljust(header_size, b'\0'))]
+        for index in sorted(self._dirty_blocks):
+            offset = index * blocks.record_size
+            entries.append((region_offset + offset,
+                            bytes(region[offset:offset+blocks.record_size])))
+        l.debug('Writing %s changed blocks in place', len(entries) - 1)
+        _write_journal(path, entries)
+        _apply_journal(path, entries)
+        os.remove(path + JOURNAL_SUFFIX)
+        self._dirty_blocks = set()
+        # Whether our private map of the file shows the changes we wrote
+        # to the file, is unspecified.  Thus we map it again.
+        with _builtin_open(path, 'rb') as f:
+            self.data[b'blocks'] = pol.blockstore.BlockStore(blocks.nblocks,
+                        blocks.width, blocks.marker_width,
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY),
+                        region_offset)
+        return True
+
+    def _packed_fixed_header(self):
+        """ Returns the packed header of the safe in the fixed format
+            together with the size of the space to reserve for it. """
+        header = dict(self.data)
+        blocks = header.pop(b'blocks')
+        header[b'block-store'] = blocks.params
+        packed_header = msgpack.packb(header, use_bin_type=True)
+        header_size = len(packed_header) + (-(len(SAFE_FIXED_MAGIC)
+                            + _fixed_header_struct.size + len(packed_header))
+                                % FIXED_ALIGNMENT)
+        return packed_header, header_size
+
+    def _store_msgpack_to_stream(self, stream):
+        """ Packs `data' to `stream' as msgpack would, but packs a
+            BlockStore block by block into a buffer sized for a chunk
+            of blocks, instead of converting it to a list first. """
+        buf_size = max([PACK_CHUNK_SIZE * _packed_block_size(value)
+                            for value in self.data.values()
+                            if isinstance(value, pol.blockstore.BlockStore)]
+                        + [FIXED_ALIGNMENT])
+        packer = msgpack.Packer(use_bin_type=True, autoreset=False,
+                                buf_size=buf_size)
+        packer.pack_map_header(len(self.data))
+        for key, value in self.data.items():
+            packer.pack(key)
+            if isinstance(value, pol.blockstore.BlockStore):
+                _pack_blocks(packer, value, stream)
+            else:
+                packer.pack(value)
+        stream.write(packer.getbuffer())
+
+    def _store_fixed_to_stream(self, stream):
+        packed_header, header_size = self._packed_fixed_header()
+        stream.write(SAFE_FIXED_MAGIC)
+        stream.write(_fixed_header_struct.pack(header_size,
+                                               len(packed_header)))
+        stream.write(packed_header.ljust(header_size, b'\0'))
+        stream.write(self.data[b'blocks'].region())
+
     @staticmethod
     def load_from_stream(stream, nworkers, use_threads):
         """ Loads a Safe form a `stream'.
 
+            If `stream' is a file in the fixed format, its blocks are
+            mapped into memory and only read when they are used.
+
             If you load from a file, use `open' for that function also
             handles locking. """
         start_time = time.time()
         l.debug('Unpacking ...')
         magic = stream.read(len(SAFE_MAGIC))
-        if magic != SAFE_MAGIC:
+        if magic == SAFE_MAGIC:
+            data = Safe._load_msgpack_from_stream(stream)
+            fmt = FORMAT_MSGPACK
+        elif magic == SAFE_FIXED_MAGIC:
+            data, header_size, file_id = Safe._load_fixed_from_stream(
+                                                                    stream)
+            fmt = FORMAT_FIXED
+        else:
             raise WrongMagicError
-        data = msgpack.unpack(stream, use_list=True, raw=True)
         l.debug(' unpacked in %.2fs', time.time() - start_time)
         if (b'type' not in data or not isinstance(data[b'type'], bytes)
                 or data[b'type'] not in TYPE_MAP):
             raise SafeFormatError("Invalid `type' attribute")
-        return TYPE_MAP[data[b'type']](data, nworkers, use_threads)
+        safe = TYPE_MAP[data[b'type']](data, nworkers, use_threads)
+        safe.format = fmt
+        if fmt == FORMAT_FIXED and file_id is not None:
+            safe._fixed_file_id = file_id
+            safe._fixed_header_size = header_size
+        return safe
+
+    @staticmethod
+    def _load_msgpack_from_stream(stream):
+        """ Unpacks the plaintext object from `stream'.  The blocks are
+            unpacked one by one into a BlockStore, such that we never
+            have them all as Python objects in memory. """
+        unpacker = msgpack.Unpacker(stream, use_list=True, raw=True)
+        data = {}
+        try:
+            for i in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key == b'blocks':
+                    data[key] = _unpack_blocks(unpacker,
+                                               data.get(b'group-params'))
+                else:
+                    data[key] = unpacker.unpack()
+        except SafeFormatError:
+            raise
+        except (ValueError, TypeError, struct.error,
+                        msgpack.UnpackException):
+            raise SafeFormatError("Plaintext object is malformed")
+        # If the group parameters came after the blocks, we could not
+        # yet determine the width of the BlockStore.
+        if isinstance(data.get(b'blocks'), _BlockBuffer):
+            data[b'blocks'] = data[b'blocks'].to_blockstore(
+                                            data.get(b'group-params'))
+        return data
+
+    @staticmethod
+    def _load_fixed_from_stream(stream):
+        raw_header = stream.read(_fixed_header_struct.size)
+        if len(raw_header) != _fixed_header_struct.size:
+            raise SafeFormatError("Header is truncated")
+        header_size, header_length = _fixed_header_struct.unpack(raw_header)
+        if header_length > header_size:
+            raise SafeFormatError("Header is larger than its reserved space")
+        packed_header = stream.read(header_size)
+        if len(packed_header) != header_size:
+            raise SafeFormatError("Header is truncated")
+        data = msgpack.unpackb(packed_header[:header_length],
+                                    use_list=True, raw=True)
+        if not isinstance(data, dict):
+            raise SafeFormatError("Header should be a dictionary")
+        params = data.pop(b'block-store', None)
+        if (not isinstance(params, dict)
+                or not isinstance(data.get(b'n-blocks'), int)
+                or not isinstance(params.get(b'width'), int)
+                or not isinstance(params.get(b'marker-width'), int)):
+            raise SafeFormatError("Invalid `block-store' attribute")
+        # If we can, we map the blocks into memory.  ACCESS_COPY makes
+        # changes to the blocks private to us.
+        try:
+            fileno = stream.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            buf = bytearray(stream.read())
+            offset = 0
+            file_id = None
+        else:
+            st = os.fstat(fileno)
+            file_id = (st.st_dev, st.st_ino)
+            buf = mmap.mmap(fileno, 0, access=mmap.ACCESS_COPY)
+            offset = (len(SAFE_FIXED_MAGIC) + _fixed_header_struct.size
+                            + header_size)
+        try:
+            data[b'blocks'] = pol.blockstore.BlockStore(data[b'n-blocks'],
+                            params[b'width'], params[b'marker-width'],
+                            buf, offset)
+        except (ValueError, struct.error):
+            raise SafeFormatError("Blocks are truncated")
+        return data, header_size, file_id
 
     @staticmethod
     def generate(typ=b'elgamal', *args, **kwargs):
@@ -184,7 +453,15 @@ class Safe(object):
             be returned. """
         raise NotImplementedError
 
-    def rerandomize(self):
+    def open_containers_many(self, passwords, additional_keys=[], **kwargs):
+        """ Opens the containers of each of `passwords'.  Returns for each
+            password the list of containers it opened. """
+        return [list(self.open_containers(password, additional_keys,
+                                          **kwargs))
+                    for password in passwords]
+
+    def rerandomize(self, nworkers=None, use_threads=False, progress=None,
+                        fraction=None):
         """ Rerandomizes the safe. """
         raise NotImplementedError
 
@@ -196,6 +473,20 @@ class Safe(object):
         """ Autosave containers """
         pass
 
+    def sync_blocks(self):
+        """ Writes the changes to the blocks that are only kept in memory
+            to `data'.  Call it before reading the blocks in `data'.
+
+            This is done automatically by `store_to_stream' and
+            `store_to_file'. """
+        pass
+
+    def close(self):
+        """ Releases resources held by the safe, like background threads.
+
+            This is done automatically if opened with `open'. """
+        pass
+
     @property
     def touched(self):
         """ True when the Safe has been changed. """
@@ -204,6 +495,10 @@ class Safe(object):
     def touch(self):
         self._touched = True
 
+    def untouch(self):
+        """ Marks the Safe as unchanged, for instance after storing it. """
+        self._touched = False
+
 class Entry(object):
     """ An entry of a container """
     @property
@@ -229,8 +524,9 @@ class Container(object):
     def add(self, key, note, secret):
         """ adds a new entry (key, note, secret) """
         raise NotImplementedError
-    def get(self, key):
-        """ Returns the entries with key `key' """
+    def get(self, key, ignore_case=False):
+        """ Returns the entries with key `key'.  If `ignore_case' is set,
+            also those with key equal to `key' up to case. """
         raise NotImplementedError
     def save(self):
         """ Saves the changes made to the container to the safe. """
@@ -274,6 +570,23 @@ KD_SYMM    = binascii.unhexlify(b'4110252b740b03c53b1c11d6373743fb')
 KD_LIST    = binascii.unhexlify(b'd53d376a7db498956d7d7f5e570509d5')
 KD_APPEND  = binascii.unhexlify(b'76001c344cbd9e73a6b5bd48b67266d9')
 
+# The secrets of a container are stored such that a single secret can be
+# decrypted on its own: see `ElGamalSafe._pack_secrets'.
+_secrets_header_struct = struct.Struct('>I')
+
+# If more blocks have changed since the process workers of the worker pool
+# of a safe were started, they are started again.  See `_pool_map'.
+POOL_MAX_STALE_BLOCKS = 1024
+
+# Number of blocks `rerandomize' maps over as one element.  The worker pool
+# picks how many of these it hands to a worker at once.
+RERANDOMIZE_CHUNK_SIZE = 64
+
+# From this number of blocks on, `rerandomize' passes the blocks to worker
+# processes in shared memory instead of through a queue.  Below it, setting
+# up the shared memory costs more than it saves.  See `pol speed'.
+RERANDOMIZE_SHARED_MEMORY_MIN_BLOCKS = 256
+
 
 class ElGamalSafe(Safe):
     """ Default implementation using rerandomization of ElGamal. """
@@ -286,7 +599,9 @@ class ElGamalSafe(Safe):
         def _get_key(self):
             return self.container.main_data.entries[self.index][0]
         def _set_key(self, new_key):
+            self.container._unindex_key(self.key, self.index)
             self.container.main_data.entries[self.index][0] = new_key
+            self.container._index_key(new_key, self.index)
             self.container.unsaved_changes = True
         key = property(_get_key, _set_key)
 
@@ -311,6 +626,7 @@ class ElGamalSafe(Safe):
         def remove(self):
             if self.container.secret_data is None:
                 raise MissingKey
+            self.container._unindex_key(self.key, self.index)
             self.container.secret_data.entries[self.index] = None
             self.container.main_data.entries[self.index] = None
             self.container.unsaved_changes = True
@@ -392,12 +708,16 @@ class ElGamalSafe(Safe):
                 self.secret_data = secret_data
                 self.append_data_updates = {}
                 self.autosave = autosave
+                self.key_index = None
+                # The decrypted append entries.  See `_open_append_entry'.
+                self.append_entries_cache = {}
             else:
                 # We are combining
                 if list_key and not self.list_key:
                     self.list_key = list_key
                     self.main_slice = main_slice
                     self.main_data = main_data
+                    self.key_index = None
                 if full_key and not self.full_key:
                     self.full_key = full_key
                     self.secret_data = secret_data
@@ -417,19 +737,22 @@ class ElGamalSafe(Safe):
                 raise MissingKey
             if not self.append_data.entries:
                 return
-            new_entries = []
-            for raw_entry in self.append_data.entries:
-                new_entries.append(
-                        pol.serialization.decode_bytes_in_son(
-                            pol.serialization.string_to_son(
-                                 self.safe.envelope.open(raw_entry,
-                                                self.secret_data.privkey))))
+            # Opening an envelope is slow: we open them in parallel.
+            new_entries = [pol.serialization.decode_bytes_in_son(
+                                pol.serialization.string_to_son(pt))
+                            for pt in self.safe.pool.map(
+                                self.safe._open_envelope,
+                                self.append_data.entries,
+                                args=(self.secret_data.privkey,),
+                                chunk_size=None)]
             if on_move_append_entries:
                 on_move_append_entries(new_entries)
             self.append_data = self.append_data._replace(entries=[])
+            self.append_entries_cache = {}
             for entry in new_entries:
                 self.secret_data.entries.append(entry[2])
                 self.main_data.entries.append(entry[:2])
+                self._index_key(entry[0], len(self.main_data.entries) - 1)
             self.touch()
 
         def save(self, randfunc=None, annex=False):
@@ -441,11 +764,8 @@ class ElGamalSafe(Safe):
                 sbs = self.safe.cipher.blocksize
                 iv = randfunc(sbs)
                 cipherstream = self.safe._cipherstream(self.full_key, iv)
-                # Filter entries that are marked for deletion
-                secret_data = self.secret_data._replace(
-                        entries=[x for x in self.secret_data.entries if x is not None])
                 # Serialize and store
-                secrets_pt = pol.serialization.son_to_string(secret_data)
+                secrets_pt = self.safe._pack_secrets(self.secret_data)
                 secrets_ct = cipherstream.encrypt(secrets_pt)
                 self.main_data = self.main_data._replace(iv=iv,
                                         secrets=secrets_ct)
@@ -461,20 +781,30 @@ class ElGamalSafe(Safe):
             # Write append slice
             if self.append_data:
                 assert self.append_key and self.append_slice
-                # First apply pending updates
+                # First apply pending updates.  We seal the updated entries
+                # in parallel.
+                updates = []
                 for index, entry in self.append_data_updates.items():
                     if entry is None:
                         self.append_data.entries[index] = None
                     else:
-                        self.append_data.entries[index] = self.safe.envelope.seal(
-                                    pol.serialization.son_to_string(entry),
-                                    self.append_data.pubkey)
+                        updates.append((index,
+                                    pol.serialization.son_to_string(entry)))
+                cts = self.safe.pool.map(self.safe._seal_envelope,
+                            [pt for index, pt in updates],
+                            args=(self.append_data.pubkey,),
+                            initializer=self.safe._seal_envelope_initializer,
+                            chunk_size=None)
+                for (index, pt), ct in zip(updates, cts):
+                    self.append_data.entries[index] = ct
                 # Then, filter entries marked for deletion
                 append_data = self.append_data._replace(
                         entries=[x for x in self.append_data.entries if x is not None])
                 # Serialize and store
                 append_pt = pol.serialization.son_to_string(append_data)
                 self.append_slice.store(self.append_key, append_pt, annex=annex)
+                # The updated entries have been sealed again.
+                self.append_entries_cache = {}
             self.unsaved_changes = False
 
         def get_by_id(self, identifier):
@@ -482,11 +812,22 @@ class ElGamalSafe(Safe):
             if kind == 'm':
                 return ElGamalSafe.MainEntry(self, i)
             assert kind == 'a'
-            entry = pol.serialization.decode_bytes_in_son(
-                            self.safe.envelope.open(
+            return ElGamalSafe.AppendEntry(self, i,
+                                           *self._open_append_entry(i))
+
+        def _open_append_entry(self, i):
+            """ Returns the triple (key, note, secret) of the append entry
+                `i'.  Opening its envelope is slow: the result is cached
+                until the container is saved. """
+            entry = self.append_entries_cache.get(i)
+            if entry is None:
+                entry = pol.serialization.decode_bytes_in_son(
+                            pol.serialization.string_to_son(
+                                self.safe.envelope.open(
                                     self.append_data.entries[i],
-                                        self.secret_data.privkey))
-            return ElGamalSafe.AppendEntry(self, i, *entry)
+                                    self.secret_data.privkey)))
+                self.append_entries_cache[i] = entry
+            return entry
 
         def list_ids(self):
             if not self.main_data:
@@ -509,40 +850,68 @@ class ElGamalSafe(Safe):
                 if entry is None:
                     continue
                 ret.append(ElGamalSafe.MainEntry(self, i))
-            # TODO cache?
             if self.secret_data and self.append_data:
                 for i, raw_entry in enumerate(self.append_data.entries):
-                    entry = pol.serialization.decode_bytes_in_son(
-                                self.safe.envelope.open(
-                                    raw_entry, self.secret_data.privkey))
-                    ret.append(ElGamalSafe.AppendEntry(self, i, *entry))
+                    if raw_entry is None:
+                        continue
+                    ret.append(ElGamalSafe.AppendEntry(self, i,
+                                        *self._open_append_entry(i)))
             return ret
 
-        def get(self, key):
+        def get(self, key, ignore_case=False):
             if not self.main_data:
                 raise MissingKey
-            for i, entry in enumerate(self.main_data.entries):
-                if entry is None:
-                    continue
-                if entry[0] != key:
-                    continue
+            by_key, by_folded_key = self._get_key_index()
+            if ignore_case:
+                key = key.casefold()
+                indices = by_folded_key.get(key, ())
+            else:
+                indices = by_key.get(key, ())
+            for i in list(indices):
                 yield ElGamalSafe.MainEntry(self, i)
             if self.secret_data and self.append_data:
                 for i, raw_entry in enumerate(self.append_data.entries):
                     if raw_entry is None:
                         continue
-                    entry = pol.serialization.decode_bytes_in_son(
-                                pol.serialization.string_to_son(
-                                    self.safe.envelope.open(raw_entry,
-                                                self.secret_data.privkey)))
-                    if entry[0] != key:
+                    entry = self._open_append_entry(i)
+                    if (entry[0].casefold() if ignore_case
+                                else entry[0]) != key:
                         continue
                     yield ElGamalSafe.AppendEntry(self, i, *entry)
 
+        def _get_key_index(self):
+            """ Returns the pair of dictionaries that map the keys, and the
+                casefolded keys, to the sorted list of the indices of the
+                main entries with that key.  They are built on first use. """
+            if self.key_index is None:
+                self.key_index = ({}, {})
+                for i, entry in enumerate(self.main_data.entries):
+                    if entry is not None:
+                        self._index_key(entry[0], i)
+            return self.key_index
+
+        def _index_key(self, key, i):
+            """ Adds the main entry `i' with key `key' to the key index. """
+            if self.key_index is None:
+                return
+            for index, k in zip(self.key_index, (key, key.casefold())):
+                bisect.insort(index.setdefault(k, []), i)
+
+        def _unindex_key(self, key, i):
+            """ Removes the main entry `i' with key `key' from the key
+                index. """
+            if self.key_index is None:
+                return
+            for index, k in zip(self.key_index, (key, key.casefold())):
+                index[k].remove(i)
+                if not index[k]:
+                    del index[k]
+
         def add(self, key, note, secret):
             if self.secret_data:
-                self.main_data.entries.append((key, note))
+                self.main_data.entries.append([key, note])
                 self.secret_data.entries.append(secret)
+                self._index_key(key, len(self.main_data.entries) - 1)
             elif self.append_data:
                 self.append_data.entries.append(None)
                 self.append_data_updates[
@@ -619,17 +988,15 @@ class ElGamalSafe(Safe):
                                 + iv
                                 + cipher.encrypt(plaintext))
             # Finally, write the blocks
-            for index, raw_block in pol.parallel.parallel_map(
-                    self._store_block,
+            # NOTE We map a method of the safe and not of the slice, as
+            #      the latter would send our plaintext to the workers.
+            for index, raw_block in self.safe._pool_map(
+                    self.safe._store_block,
                     [(ciphertext[bpb*indexindex:bpb*(indexindex+1)], index)
                         for indexindex, index in enumerate(self.indices)],
                     args=(key, annex),
-                    initializer=self._store_block_initializer,
-                    nworkers=self.safe.nworkers,
-                    use_threads=self.safe.use_threads,
-                    chunk_size=8):
-                if raw_block is None:
-                    raise WrongKeyError
+                    initializer=self.safe._store_block_initializer,
+                    chunk_size=None):
                 self.safe._write_block(index, raw_block)
             self._value = value
             duration = time.time() - time_started
@@ -637,32 +1004,46 @@ class ElGamalSafe(Safe):
                         duration, len(self.indices) / duration)
             self.safe.touch()
 
-        def _store_block(self, ct_index, key, annex, randfunc):
-            try:
-                ct, index = ct_index
-                return index, self.safe._eg_encrypt_block(key, index, ct,
-                                                randfunc, annex=annex)
-            except WrongKeyError:
-                # TODO it would  be prettier if parallel_map passes the
-                #      exception
-                return index, None
-        def _store_block_initializer(self, args, kwargs):
-            Crypto.Random.atfork()
-            kwargs['randfunc'] = Crypto.Random.new().read
 
     def __init__(self, data, nworkers, use_threads):
         super(ElGamalSafe, self).__init__(data, nworkers, use_threads)
         # maps first index of mainslice and/or appendslice to
         # a wealref to an already opened Container.
         self._opened_containers = {}
+        # maps the marker of a block to its index.  See `_get_marker_index'.
+        self._marker_index = None
+        # indices of blocks written to since the last rerandomization
+        self._written_blocks = set()
+        # maps the index of a block to the list [c1, c2, pubkey] of
+        # its numbers, each decoded from `data' on first use or None.
+        # See `_block_number'.
+        self._block_numbers = {}
+        # indices of blocks of which the numbers have changed, but
+        # which have not been written to `data'.  See `sync_blocks'.
+        self._unsynced_blocks = set()
+        # See `start_factor_pool'
+        self._factor_pool = None
+        # See `pool'
+        self._pool = None
+        # indices of blocks changed since the process workers of `pool'
+        # were started.  See `_pool_map'.
+        self._pool_stale_blocks = set()
+        # the process that created the safe, as opposed to its workers
+        self._pid = os.getpid()
+        # Held while the blocks or their numbers are changed, by other
+        # threads, like the one of the factor pool, while they read them
+        # and while the process workers of `pool' are forked.
+        self._blocks_lock = threading.RLock()
         # Check if `data' makes sense.
         self.free_blocks = set([])
         for attr in (b'group-params', b'n-blocks', b'blocks',
                         b'block-index-size', b'slice-size'):
             if not attr in data:
                 raise SafeFormatError("Missing attr `%s'" % attr)
-        for attr, _type in {b'blocks': list,
-                            b'group-params': list,
+        if not isinstance(data[b'blocks'], (list,
+                                            pol.blockstore.BlockStore)):
+            raise SafeFormatError("`blocks' should be a `list'")
+        for attr, _type in {b'group-params': list,
                             b'block-index-size': int,
                             b'slice-size': int,
                             b'bytes-per-block': int,
@@ -671,12 +1052,34 @@ class ElGamalSafe(Safe):
                 raise SafeFormatError("`%s' should be a `%s'" % (attr, _type))
         if not len(data[b'blocks']) == data[b'n-blocks']:
             raise SafeFormatError("Amount of blocks isn't `n-blocks'")
+        if not isinstance(data.get(b'rerandomize-cursor', 0), int):
+            raise SafeFormatError("`rerandomize-cursor' should be a `int'")
         if not len(data[b'group-params']) == 2:
             raise SafeFormatError("`group-params' should contain 2 elements")
         # TODO Should we check whether the group parameters are safe?
         for x in data[b'group-params']:
             if not isinstance(x, bytes):
                 raise SafeFormatError("`group-params' should contain bytes")
+        # The group parameters are used for every block we touch.  Thus
+        # we parse them only once.
+        self._group_params = pol.elgamal.group_parameters(
+                    *[pol.serialization.string_to_number(x)
+                        for x in data[b'group-params']])
+        # The maximum size of c1, c2 and the public key of a block
+        self._block_width = (gmpy2.num_digits(self._group_params.p, 2)
+                                    + 7) // 8
+        # The blocks are kept in a BlockStore.  If we got them as a list,
+        # we convert them.
+        if isinstance(data[b'blocks'], list):
+            try:
+                data[b'blocks'] = pol.blockstore.BlockStore.from_list(
+                                    data[b'blocks'], self._block_width)
+            except (ValueError, TypeError, struct.error):
+                raise SafeFormatError("`blocks' should contain four "+
+                                      "strings of the right size")
+        elif data[b'blocks'].width < self._block_width:
+            raise SafeFormatError("`blocks' are too narrow for "+
+                                  "`group-params'")
         if data[b'slice-size'] == 2:
             self._slice_size_struct = struct.Struct('>H')
         elif data[b'slice-size'] == 4:
@@ -733,7 +1136,8 @@ class ElGamalSafe(Safe):
                  b'key-derivation': kd.params,
                  b'envelope': envelope.params,
                  b'block-cipher': cipher.params,
-                 b'blocks': [[b'',b'',b'',b''] for i in range(n_blocks)]},
+                 b'blocks': pol.blockstore.BlockStore(n_blocks,
+                                    (gmpy2.num_digits(gp.p, 2) + 7) // 8)},
                         nworkers, use_threads)
         # Mark all blocks as free
         safe.mark_free(range(n_blocks))
@@ -741,28 +1145,74 @@ class ElGamalSafe(Safe):
 
     def open_containers(self, password, additional_keys=None, autosave=True,
                             move_append_entries=True,
-                            on_move_append_entries=None):
+                            on_move_append_entries=None, with_access=False):
         """ Opens a container.
 
             If there are entries in the append-slice, `on_move_append_entries'
-            will be called with the entries as only argument. """
+            will be called with the entries as only argument.
+
+            If `with_access' is set, yields pairs (container, access) where
+            `access' is the access `password' gives to the container: one
+            of AS_FULL, AS_LIST or AS_APPEND.  The container itself might
+            give more access, if it has been opened with another password
+            as well. """
         l.debug('open_containers: Stretching key')
         assert isinstance(password, bytes) # XXX
-        access_key = self.ks(self._composite_password(
-                                    password, additional_keys))
+        access_key = self._stretch(password, additional_keys)
         l.debug('open_containers: Searching for access slice ...')
         for sl in self._find_slices(access_key):
-            access_data = access_tuple(*pol.serialization.string_to_son(
-                                sl.value))
-            if access_data.magic != AS_MAGIC:
-                l.warn('Wrong magic on access slice')
-                continue
-            l.debug('open_containers:  found one @%s; type %s',
-                            sl.first_index, access_data.type)
-            container = self._open_container_with_access_data(
-                            access_data, move_append_entries,
-                            on_move_append_entries, autosave)
-            yield container
+            opened = self._open_container_with_access_slice(sl,
+                            move_append_entries, on_move_append_entries,
+                            autosave)
+            if opened is not None:
+                yield opened if with_access else opened[0]
+
+    def open_containers_many(self, passwords, additional_keys=None,
+                                autosave=True, move_append_entries=True,
+                                on_move_append_entries=None,
+                                with_access=False):
+        """ Opens the containers of each of `passwords'.  Returns for each
+            password the list of containers it opened.  If `with_access' is
+            set, the lists contain pairs (container, access) as yielded by
+            `open_containers'.
+
+            Contrary to calling `open_containers' for each password, the
+            passwords are stretched concurrently and the blocks are
+            searched only once for the access slices of all of them. """
+        if not passwords:
+            return []
+        for password in passwords:
+            assert isinstance(password, bytes) # XXX
+        l.debug('open_containers_many: Stretching %s keys', len(passwords))
+        # The key-stretching releases the GIL: threads suffice.
+        access_keys = pol.parallel.parallel_map(self._stretch, passwords,
+                            args=(additional_keys,), chunk_size=1,
+                            nworkers=len(passwords), use_threads=True)
+        l.debug('open_containers_many: Searching for access slices ...')
+        ret = [[] for password in passwords]
+        for key_index, sl in self._find_slices_many(access_keys):
+            opened = self._open_container_with_access_slice(sl,
+                            move_append_entries, on_move_append_entries,
+                            autosave)
+            if opened is not None:
+                ret[key_index].append(opened if with_access else opened[0])
+        return ret
+
+    def _open_container_with_access_slice(self, sl, move_append_entries,
+                                on_move_append_entries, autosave):
+        """ Opens the container of the access slice `sl'.  Returns the pair
+            (container, type of the access slice) or None if `sl' is not an
+            access slice. """
+        access_data = access_tuple(*pol.serialization.string_to_son(
+                            sl.value))
+        if access_data.magic != AS_MAGIC:
+            l.warn('Wrong magic on access slice')
+            return None
+        l.debug('open_containers:  found one @%s; type %s',
+                        sl.first_index, access_data.type)
+        return (self._open_container_with_access_data(
+                        access_data, move_append_entries,
+                        on_move_append_entries, autosave), access_data.type)
 
     def _open_container_with_access_data(self, access_data,
                         move_append_entries=True,
@@ -798,14 +1248,8 @@ class ElGamalSafe(Safe):
             append_index = main_data.append_index
         # Now, read secret data if we have access
         if full_key:
-            cipherstream = self._cipherstream(full_key, main_data.iv)
-            secret_data = secret_tuple(*pol.serialization.string_to_son(
-                            cipherstream.decrypt(main_data.secrets)))
-            # msgpack has converted our secret str()s to bytes()s;
-            # convert then back.
-            secret_data = secret_data._replace(
-                entries=pol.serialization.decode_bytes_in_son(
-                    secret_data.entries))
+            secret_data = self._unpack_secrets(full_key, main_data.iv,
+                                               main_data.secrets)
         # Read the append-data, if it exists
         if append_index is not None:
             append_slice = self._load_slice(append_key, append_index)
@@ -881,14 +1325,11 @@ class ElGamalSafe(Safe):
         list_key = self.kd([full_key, KD_LIST])
         append_key = self.kd([list_key, KD_APPEND])
         # Derive keys from passwords
-        as_full_key = self.ks(self._composite_password(
-                                password, additional_keys))
+        as_full_key = self._stretch(password, additional_keys)
         if append_password:
-            as_append_key = self.ks(self._composite_password(
-                                append_password, additional_keys))
+            as_append_key = self._stretch(append_password, additional_keys)
         if list_password:
-            as_list_key = self.ks(self._composite_password(
-                                list_password, additional_keys))
+            as_list_key = self._stretch(list_password, additional_keys)
         # Create access slices
         l.debug('new_container: creating access slices')
         as_full.store(as_full_key, pol.serialization.son_to_string(
@@ -962,9 +1403,7 @@ class ElGamalSafe(Safe):
     @property
     def group_params(self):
         """ The group parameters. """
-        return pol.elgamal.group_parameters(
-                    *[pol.serialization.string_to_number(x)
-                        for x in self.data[b'group-params']])
+        return self._group_params
 
     def mark_free(self, indices):
         """ Marks the given indices as free. """
@@ -983,30 +1422,204 @@ class ElGamalSafe(Safe):
             if container and container.autosave and container.unsaved_changes:
                 container.save()
 
-    def rerandomize(self, nworkers=None, use_threads=False, progress=None):
+    def start_factor_pool(self, max_size=None):
+        """ Starts to precompute, in a background thread, the factors
+            used to rerandomize blocks.  With these, `rerandomize' only
+            has to multiply.  Useful while waiting on the user.
+
+            At most `max_size' (by default: the number of blocks) factors
+            are kept.  They are discarded by `close'. """
+        if self._factor_pool is not None:
+            return
+        self._factor_pool = RerandomizationFactorPool(self,
+                        self.nblocks if max_size is None else max_size)
+
+    @property
+    def pool(self):
+        """ The pol.parallel.WorkerPool used to decrypt and encrypt blocks
+            in parallel.  It is created on first use and closed
+            by `close'. """
+        if self._pool is None:
+            self._pool = pol.parallel.WorkerPool(self.nworkers,
+                                    self.use_threads, shared=(self,),
+                                    fork_lock=self._blocks_lock,
+                                    on_fork=self._pool_forked)
+        return self._pool
+
+    def _pool_map(self, func, seq, args=(), initializer=None, chunk_size=1):
+        """ Maps `func', a method of the safe that reads its blocks, over
+            `seq' on `pool'.
+
+            The process workers of `pool' have a copy of the safe from
+            when they were started.  Instead of starting them again when
+            a block changes, the changed blocks are sent along with the
+            job and applied by `_pool_map_initializer'. """
+        updates = {}
+        if not self.pool.use_threads:
+            for index in self._pool_stale_blocks:
+                updates[index] = (self.data[b'blocks'][index],
+                                  self._block_numbers.get(index))
+        return self.pool.map(func, seq, args=args,
+                        kwargs={'block_updates': updates,
+                                'initializer': initializer},
+                        chunk_size=chunk_size,
+                        initializer=self._pool_map_initializer)
+
+    def _pool_map_initializer(self, args, kwargs):
+        updates = kwargs.pop('block_updates')
+        initializer = kwargs.pop('initializer')
+        # Also called in our own process, which has the changes already.
+        if os.getpid() != self._pid:
+            blocks = self.data[b'blocks']
+            for index, (raw_b, numbers) in updates.items():
+                if self._marker_index is not None:
+                    old_marker = blocks[index][3]
+                    if self._marker_index.get(old_marker) == index:
+                        del self._marker_index[old_marker]
+                    self._marker_index[raw_b[3]] = index
+                blocks[index] = raw_b
+                if numbers is None:
+                    self._block_numbers.pop(index, None)
+                else:
+                    self._block_numbers[index] = numbers
+        if initializer is not None:
+            initializer(args, kwargs)
+
+    def _pool_forked(self):
+        # The new process workers have the blocks as they are now.
+        self._pool_stale_blocks = set()
+
+    def _blocks_changed(self, indices):
+        """ Notes that the blocks `indices' have changed.  See `_pool_map'. """
+        self._pool_stale_blocks.update(indices)
+        if len(self._pool_stale_blocks) > POOL_MAX_STALE_BLOCKS:
+            # Sending this many blocks with every job costs more than
+            # starting the workers again.
+            if self._pool is not None:
+                self._pool.invalidate()
+            self._pool_stale_blocks = set()
+
+    def close(self):
+        if self._factor_pool is not None:
+            self._factor_pool.stop()
+            self._factor_pool = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def rerandomize(self, nworkers=None, use_threads=False, progress=None,
+                        fraction=None):
         """ Rerandomizes blocks: they will still decrypt to the same
-            plaintext. """
+            plaintext.
+
+            If `fraction' is set, only that fraction of the blocks is
+            rerandomized, together with the blocks written to since the
+            last rerandomization.  The fraction of blocks is a window
+            that rotates with every call, such that every block is
+            rerandomized at least once every ceil(1/fraction) calls.
+
+            NOTE With `fraction' set, one can tell which blocks have been
+                 written to by comparing two versions of the safe. """
+        if fraction is None or fraction >= 1:
+            indices = range(self.nblocks)
+        elif fraction <= 0:
+            raise ValueError("`fraction' should be positive")
+        else:
+            indices = sorted(self._next_rerandomize_window(fraction)
+                                | self._written_blocks)
         _progress = None
         if progress is not None:
             def _progress(n):
-                progress(float(n) / self.nblocks)
+                progress(min(1.0, float(n) * RERANDOMIZE_CHUNK_SIZE
+                                        / len(indices)))
         if not nworkers:
             nworkers = multiprocessing.cpu_count()
-        l.debug("Rerandomizing %s blocks on %s workers ...",
-                    self.nblocks, nworkers)
+        l.debug("Rerandomizing %s of %s blocks on %s workers ...",
+                    len(indices), self.nblocks, nworkers)
         start_time = time.time()
         gp = self.group_params
-        self.data[b'blocks'] = pol.parallel.parallel_map(_eg_rerandomize_block,
-                        self.data[b'blocks'], args=(gp.g, gp.p),
-                        nworkers=nworkers, use_threads=use_threads,
-                        initializer=_eg_rerandomize_block_initializer,
-                        chunk_size=16, progress=_progress)
+        # Build the table for g^s before the workers are started such that
+        # they do not each have to.
+        pol.elgamal.fixed_base_table(gp)
+        blocks = self.data[b'blocks']
+        self._dirty_blocks.update(indices)
+        # First use the factors precomputed by the factor pool, if any.
+        # The rerandomized blocks are kept as numbers.
+        factors = (self._factor_pool.take(indices)
+                        if self._factor_pool is not None else {})
+        if factors:
+            l.debug(" using %s precomputed factors", len(factors))
+            indices_left = []
+            for index in indices:
+                factor = factors.get(index)
+                if factor is None or factor[0] != self._block_number(index, 2):
+                    indices_left.append(index)
+                    continue
+                self._set_block_numbers(index,
+                        (self._block_number(index, 0) * factor[1]) % gp.p,
+                        (self._block_number(index, 1) * factor[2]) % gp.p)
+            indices = indices_left
+        # The workers get the other blocks as they are stored.
+        self.sync_blocks()
+        selected = blocks.take(indices)
+        chunks = [(i, min(i + RERANDOMIZE_CHUNK_SIZE, len(selected)))
+                        for i in range(0, len(selected), RERANDOMIZE_CHUNK_SIZE)]
+        if (nworkers, use_threads) == (self.pool.nworkers,
+                                       self.pool.use_threads):
+            _map = self.pool.map
+        else:
+            _map = functools.partial(pol.parallel.parallel_map,
+                                nworkers=nworkers, use_threads=use_threads)
+        if (not use_threads and pol.parallel.have_shared_memory
+                and len(selected) >= RERANDOMIZE_SHARED_MEMORY_MIN_BLOCKS):
+            # Worker processes rerandomize the blocks in place in shared
+            # memory.  Only the ranges of blocks go through the queue.
+            shared = pol.parallel.SharedBuffer(len(selected.region()))
+            try:
+                shared.buf[:] = selected.region()
+                _map(_eg_rerandomize_shared, chunks,
+                        args=(shared, (len(selected), selected.width,
+                                       selected.marker_width), gp),
+                        initializer=_eg_rerandomize_blocks_initializer,
+                        progress=_progress, chunk_size=None)
+                selected.region()[:] = shared.buf
+            finally:
+                shared.close()
+                shared.unlink()
+        else:
+            # Threads rerandomize the views on `selected' in place.  Worker
+            # processes get and return a compact copy of their view.
+            views = [selected.view(start, stop) for start, stop in chunks]
+            for view, new_view in zip(views, _map(_eg_rerandomize_store,
+                            views, args=(gp,),
+                            initializer=_eg_rerandomize_blocks_initializer,
+                            progress=_progress, chunk_size=None)):
+                if new_view is not view:
+                    view.region()[:] = new_view.region()
+        with self._blocks_lock:
+            blocks.put(indices, selected)
+            for index in indices:
+                numbers = self._block_numbers.get(index)
+                if numbers is not None:
+                    numbers[0] = numbers[1] = None
+        self._blocks_changed(indices)
+        self._written_blocks = set()
+        # The blocks have been replaced.
+        self._marker_index = None
         secs = time.time() - start_time
-        kbps = self.nblocks * gmpy2.num_digits(gp.p,2) / 1024.0 / 8.0 / secs
+        kbps = len(indices) * gmpy2.num_digits(gp.p,2) / 1024.0 / 8.0 / secs
         if progress is not None:
             progress(1.0)
         l.debug(" done in %.2fs; that is %.2f KB/s", secs, kbps)
 
+    def _next_rerandomize_window(self, fraction):
+        """ Returns the next window of `fraction' of the blocks to
+            rerandomize and moves the cursor stored in the safe past it. """
+        n = min(self.nblocks, int(math.ceil(fraction * self.nblocks)))
+        cursor = self.data.get(b'rerandomize-cursor', 0) % self.nblocks
+        self.data[b'rerandomize-cursor'] = (cursor + n) % self.nblocks
+        return set((cursor + i) % self.nblocks for i in range(n))
+
     def _new_slice(self, nblocks):
         """ Allocates a new slice with `nblocks' space. """
         if len(self.free_blocks) < nblocks:
@@ -1022,17 +1635,51 @@ class ElGamalSafe(Safe):
 
     def _find_slices(self, key):
         """ Find slices that are opened by base key `key' """
-        symmkey_hash = self.kd([self._cipherstream_key(key)],
-                            length=self.cipher.blocksize)
-        # TODO parallelize this
-        for index in range(self.nblocks):
-            try:
-                pt = self._eg_decrypt_block(key, index)
-            except WrongKeyError:
-                continue
-            # We got a block.  Is it the first block?
-            if pt.startswith(symmkey_hash):
-                yield self._load_slice_from_first_block(key, index, pt)
+        for key_index, sl in self._find_slices_many([key]):
+            yield sl
+
+    def _find_slices_many(self, keys):
+        """ Find slices that are opened by any of the base keys `keys'.
+            Yields pairs (index of key in `keys', slice). """
+        symmkey_hashes = [self.kd([self._cipherstream_key(key)],
+                                  length=self.cipher.blocksize)
+                            for key in keys]
+        # Only blocks that carry a marker can be ours.  We check their
+        # markers for all keys and decrypt the blocks that are ours in
+        # parallel.
+        indices = sorted(self._get_marker_index().values())
+        for found in self._pool_map(self._find_slices_in_blocks,
+                        [indices[i:i+256] for i in range(0, len(indices), 256)],
+                        args=(keys,)):
+            for key_index, index, pt in found:
+                # We got a block.  Is it the first block?
+                if pt.startswith(symmkey_hashes[key_index]):
+                    yield key_index, self._load_slice_from_first_block(
+                                            keys[key_index], index, pt)
+
+    def _find_slices_in_blocks(self, indices, keys):
+        """ Returns (index of key, index, plaintext) for those blocks among
+            `indices' that are marked as owned by one of `keys'. """
+        marker_index = self._get_marker_index()
+        ret = []
+        for key_index, key in enumerate(keys):
+            for index, marker in zip(indices,
+                                     self._markers_for_blocks(key, indices)):
+                if marker_index.get(marker) == index:
+                    ret.append((key_index, index,
+                                self._eg_decrypt_block(key, index)))
+        return ret
+
+    def _get_marker_index(self):
+        """ Returns a dictionary that maps the marker of each block to
+            its index.  It is built on first use and kept up-to-date by
+            `_write_block'. """
+        if self._marker_index is None:
+            self._marker_index = {}
+            for index, marker in enumerate(self.data[b'blocks'].markers()):
+                if marker:
+                    self._marker_index[marker] = index
+        return self._marker_index
 
     def _load_slice(self, key, index):
         """ Loads the slice with first block `index' encrypted
@@ -1055,32 +1702,32 @@ class ElGamalSafe(Safe):
         cipherstream = self._cipherstream(key, iv)
         # Secondly, read the amount of blocks in the slice
         pt = cipherstream.decrypt(fbct[offset:])
-        indices_to_read = self._index_from_bytes(
-                            pt[:self.block_index_size]) - 1
+        n_indices = self._index_from_bytes(pt[:self.block_index_size])
         offset = self.block_index_size
-        # Now, read the indices
-        indexindex = 0
-        while indices_to_read:
-            if offset + self.block_index_size > len(pt):
-                indexindex += 1
-                assert len(indices) > indexindex
-                pt += cipherstream.decrypt(self._eg_decrypt_block(
-                                            key, indices[indexindex]))
-            indices.append(self._index_from_bytes(
-                            pt[offset:offset+self.block_index_size]))
-            offset += self.block_index_size
-            indices_to_read -= 1
-        # Read the remaining blocks
-        pt += b''.join(pol.parallel.parallel_map(
-                self._load_block,
-                [(ii*self.bytes_per_block - self.cipher.blocksize*2,
-                                indices[ii])
-                        for ii in range(indexindex+1, len(indices))],
-                args=(self._cipherstream_key(key), key, iv),
-                initializer=self._load_block_initializer,
-                nworkers=self.nworkers,
-                use_threads=self.use_threads,
-                chunk_size=8))
+        # Now, read the indices and the remaining blocks.  The indices of
+        # the blocks are stored in the first blocks of the slice.  Thus we
+        # read the blocks in waves: every wave decrypts, in parallel, all
+        # blocks of which we know the index, but which we did not read yet.
+        # As a block holds many indices, there are only a few waves.
+        n_read = 1
+        while True:
+            while (len(indices) < n_indices
+                    and offset + self.block_index_size <= len(pt)):
+                indices.append(self._index_from_bytes(
+                                pt[offset:offset+self.block_index_size]))
+                offset += self.block_index_size
+            if n_read == len(indices):
+                break
+            pt += b''.join(self._pool_map(
+                    self._load_block,
+                    [(ii*self.bytes_per_block - self.cipher.blocksize*2,
+                                    indices[ii])
+                            for ii in range(n_read, len(indices))],
+                    args=(self._cipherstream_key(key), key, iv),
+                    initializer=self._load_block_initializer,
+                    chunk_size=None))
+            n_read = len(indices)
+        assert len(indices) == n_indices
         # Read size
         size = self._slice_size_from_bytes(pt[offset:offset+self.slice_size])
         offset += self.slice_size
@@ -1091,6 +1738,60 @@ class ElGamalSafe(Safe):
                     len(indices), duration, len(indices) / duration)
         return ret
 
+    def _pack_secrets(self, secret_data):
+        """ Serializes `secret_data' without the entries marked for deletion.
+
+            The result is FMT_INDEXED, followed by the length of the header
+            as a big-endian 32-bit integer, the header and the secrets.  The
+            header is the pair (privkey, sizes) where `sizes' are the
+            lengths of the secrets, which are each serialized on their own.
+            Thus a secret can be decrypted without decrypting the others.
+            See `_unpack_secrets'.
+
+            Older versions of pol cannot read this encoding.  Hence it is
+            only used in safes of FORMAT_FIXED, which they cannot read
+            either.  Otherwise `secret_data' is serialized at once. """
+        entries = secret_data.entries
+        if self.format != FORMAT_FIXED:
+            return pol.serialization.son_to_string(secret_data._replace(
+                    entries=[secret for secret in entries
+                                if secret is not None]))
+        if isinstance(entries, _LazySecrets):
+            records = entries.records()
+        else:
+            records = [pol.serialization.son_to_string(secret)
+                            for secret in entries if secret is not None]
+        header = pol.serialization.son_to_string([secret_data.privkey,
+                                    [len(record) for record in records]])
+        return b''.join([pol.serialization.FMT_INDEXED,
+                         _secrets_header_struct.pack(len(header)),
+                         header] + records)
+
+    def _unpack_secrets(self, key, iv, ct):
+        """ Reads the secret_tuple from `ct', the ciphertext of
+            `_pack_secrets' with `key' and `iv'.  Only the header is
+            decrypted: the secrets are decrypted when they are read. """
+        cipherstream_key = self._cipherstream_key(key)
+        head_size = 1 + _secrets_header_struct.size
+        head = _decrypt_range(self.cipher, cipherstream_key, iv, ct,
+                              0, head_size)
+        if head[:1] != pol.serialization.FMT_INDEXED:
+            # Secrets stored by an older version of pol: all at once.
+            secret_data = secret_tuple(*pol.serialization.string_to_son(
+                            self._cipherstream(key, iv).decrypt(ct)))
+            # msgpack has converted our secret str()s to bytes()s;
+            # convert then back.
+            return secret_data._replace(
+                entries=pol.serialization.decode_bytes_in_son(
+                    secret_data.entries))
+        header_size = _secrets_header_struct.unpack(head[1:])[0]
+        privkey, sizes = pol.serialization.string_to_son(_decrypt_range(
+                            self.cipher, cipherstream_key, iv, ct,
+                            head_size, head_size + header_size))
+        return secret_tuple(privkey=privkey, entries=_LazySecrets(
+                            self.cipher, cipherstream_key, iv, ct,
+                            head_size + header_size, sizes))
+
     def _index_to_bytes(self, index):
         return self._block_index_struct.pack(index)
     def _index_from_bytes(self, s):
@@ -1112,6 +1813,10 @@ class ElGamalSafe(Safe):
             by `key' """
         # TODO make this faster with a secure RNG?
         return self.kd([key, KD_MARKER, self._index_to_bytes(index)])
+    def _markers_for_blocks(self, key, indices):
+        """ Returns the markers for the blocks `indices' owned by `key' """
+        return self.kd.derive_many([key, KD_MARKER],
+                        [self._index_to_bytes(index) for index in indices])
     def _privkey_for_block(self, key, index):
         """ Returns the elgamal private key for the block `index' """
         # TODO is it safe to reduce the size of privkey by this much?
@@ -1127,6 +1832,27 @@ class ElGamalSafe(Safe):
         return self.cipher.new_stream(cipherstream_key, iv,
                 offset=offset).decrypt(self._eg_decrypt_block(key, index))
 
+    def _store_block_initializer(self, args, kwargs):
+        Crypto.Random.atfork()
+        kwargs['randfunc'] = Crypto.Random.new().read
+    def _store_block(self, ct_index, key, annex, randfunc):
+        ct, index = ct_index
+        return index, self._eg_encrypt_block(key, index, ct, randfunc,
+                                             annex=annex)
+
+    # Envelopes of append entries, opened and sealed by the worker pool
+    def _open_envelope(self, ct, privkey):
+        """ Opens the sealed append entry `ct' with `privkey' """
+        return self.envelope.open(ct, privkey)
+
+    def _seal_envelope_initializer(self, args, kwargs):
+        """ Reseeds the random number generator after a fork """
+        Crypto.Random.atfork()
+
+    def _seal_envelope(self, pt, pubkey):
+        """ Seals the serialized append entry `pt' for `pubkey' """
+        return self.envelope.seal(pt, pubkey)
+
     def _eg_decrypt_block(self, key, index):
         """ Decrypts the block `index' with `key' """
         marker = self._marker_for_block(key, index)
@@ -1134,20 +1860,63 @@ class ElGamalSafe(Safe):
             raise WrongKeyError
         privkey = self._privkey_for_block(key, index)
         gp = self.group_params
-        c1 = pol.serialization.string_to_number(self.data[b'blocks'][index][0])
-        c2 = pol.serialization.string_to_number(self.data[b'blocks'][index][1])
-        return pol.elgamal.decrypt(c1, c2, privkey, gp, self.bytes_per_block)
+        return pol.elgamal.decrypt(self._block_number(index, 0),
+                                   self._block_number(index, 1),
+                                   privkey, gp, self.bytes_per_block)
+    def _block_number(self, index, field):
+        """ Returns c1, c2 or the pubkey (for `field' 0, 1 or 2) of
+            block `index' as a number.  It is decoded only once. """
+        numbers = self._block_numbers.get(index)
+        if numbers is None:
+            numbers = self._block_numbers[index] = [None, None, None]
+        if numbers[field] is None:
+            numbers[field] = pol.serialization.string_to_number(
+                                    self.data[b'blocks'][index][field])
+        return numbers[field]
+    def _set_block_numbers(self, index, c1, c2, pubkey=None):
+        """ Changes the numbers of block `index'.  They are written to
+            `data' by `sync_blocks'. """
+        with self._blocks_lock:
+            numbers = self._block_numbers.get(index)
+            if numbers is None:
+                numbers = self._block_numbers[index] = [None, None, None]
+            numbers[0] = c1
+            numbers[1] = c2
+            if pubkey is not None:
+                numbers[2] = pubkey
+            self._unsynced_blocks.add(index)
+    def sync_blocks(self):
+        blocks = self.data[b'blocks']
+        number_to_string = pol.serialization.number_to_string
+        with self._blocks_lock:
+            for index in sorted(self._unsynced_blocks):
+                raw_b = blocks[index]
+                for field, number in enumerate(self._block_numbers[index]):
+                    if number is not None:
+                        raw_b[field] = number_to_string(number)
+                blocks[index] = raw_b
+            self._unsynced_blocks = set()
     def _write_block(self, index, block):
         """ Apply changes returned by `_eg_encrypt_block'. """
-        self.data[b'blocks'][index][0] = block[0]
-        self.data[b'blocks'][index][1] = block[1]
-        if block[2] is not None:
-            self.data[b'blocks'][index][2] = block[2]
+        self._written_blocks.add(index)
+        self._dirty_blocks.add(index)
+        self._blocks_changed((index,))
+        self._set_block_numbers(index, block[0], block[1], block[2])
         if block[3] is not None:
-            self.data[b'blocks'][index][3] = block[3]
+            # The marker is stored right away, for `_get_marker_index'.
+            with self._blocks_lock:
+                raw_b = self.data[b'blocks'][index]
+                if self._marker_index is not None:
+                    old_marker = raw_b[3]
+                    if self._marker_index.get(old_marker) == index:
+                        del self._marker_index[old_marker]
+                    self._marker_index[block[3]] = index
+                raw_b[3] = block[3]
+                self.data[b'blocks'][index] = raw_b
     def _eg_encrypt_block(self, key, index, s, randfunc, annex=False):
-        """ Returns the changed entries for block `index' such that it
-            encrypts `s' using `key'.  Use `_write_block' to apply. """
+        """ Returns the changed entries [c1, c2, pubkey, marker] for block
+            `index' such that it encrypts `s' using `key'.  c1, c2 and the
+            pubkey are numbers.  Use `_write_block' to apply. """
         # We do not write immediately, such that _eg_encrypt_block can
         # be called in a separate process.
         assert len(s) <= self.bytes_per_block
@@ -1159,36 +1928,343 @@ class ElGamalSafe(Safe):
             if not annex:
                 raise WrongKeyError
             pubkey = pol.elgamal.pubkey_from_privkey(privkey, gp)
-            binary_pubkey = pol.serialization.number_to_string(pubkey)
-            ret[2] = binary_pubkey
+            ret[2] = pubkey
             ret[3] = marker
         else:
-            pubkey = pol.serialization.string_to_number(
-                        self.data[b'blocks'][index][2])
+            pubkey = self._block_number(index, 2)
         # TODO is it safe to pick r so much smaller than p?
-        c1, c2 = pol.elgamal.encrypt(s, pubkey, gp,
-                                     self.bytes_per_block, randfunc)
-        ret[0] = pol.serialization.number_to_string(c1)
-        ret[1] = pol.serialization.number_to_string(c2)
+        ret[0], ret[1] = pol.elgamal.encrypt(s, pubkey, gp,
+                                             self.bytes_per_block, randfunc)
         return ret
+    def _stretch(self, password, additional_keys):
+        """ Stretches `password' combined with `additional_keys' to the
+            key of an access slice.  Uses `ks_cache', if set. """
+        composite_password = self._composite_password(password,
+                                                      additional_keys)
+        if self.ks_cache is not None:
+            return self.ks_cache.stretch(self.ks, composite_password)
+        return self.ks(composite_password)
     def _composite_password(self, password, additional_keys):
         additional_keys = list(sorted(additional_keys
                                         if additional_keys else []))
         return (self.kd([password] + additional_keys)
                             if additional_keys else password)
 
-def _eg_rerandomize_block_initializer(args, kwargs):
+def _write_journal(path, entries):
+    """ Writes the list `entries' of pairs (offset, data) that are to be
+        written to the safe at `path' to its journal.
+
+        The journal consists of JOURNAL_MAGIC; the number of entries; for
+        each entry its offset, the length of its data and its data and
+        finally the SHA-256 hash of all that came before. """
+    h = hashlib.sha256()
+    with _builtin_open(path + JOURNAL_SUFFIX, 'wb') as f:
+        def write(s):
+            h.update(s)
+            f.write(s)
+        write(JOURNAL_MAGIC)
+        write(struct.pack('>I', len(entries)))
+        for offset, data in entries:
+            write(_journal_entry_struct.pack(offset, len(data)))
+            write(data)
+        f.write(h.digest())
+        f.flush()
+        os.fsync(f.fileno())
+    _fsync_directory(path)
+
+def _read_journal(path):
+    """ Returns the entries in the journal of the safe at `path'.  Returns
+        None if the journal is incomplete. """
+    with _builtin_open(path + JOURNAL_SUFFIX, 'rb') as f:
+        journal = f.read()
+    body, digest = journal[:-32], journal[-32:]
+    if (len(journal) < len(JOURNAL_MAGIC) + 4 + 32
+            or not body.startswith(JOURNAL_MAGIC)
+            or hashlib.sha256(body).digest() != digest):
+        return None
+    entries = []
+    offset = len(JOURNAL_MAGIC) + 4
+    for i in range(struct.unpack_from('>I', body, len(JOURNAL_MAGIC))[0]):
+        file_offset, length = _journal_entry_struct.unpack_from(body, offset)
+        offset += _journal_entry_struct.size
+        entries.append((file_offset, body[offset:offset+length]))
+        offset += length
+    return entries
+
+def _apply_journal(path, entries):
+    """ Writes the entries of a journal to the safe at `path'. """
+    with _builtin_open(path, 'r+b') as f:
+        for offset, data in entries:
+            f.seek(offset)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _replay_journal(path):
+    """ Completes the changes in the journal of the safe at `path', if
+        there is one, and removes it.  Changes in an incomplete journal
+        have not been started on, so such a journal is simply removed. """
+    if not os.path.exists(path + JOURNAL_SUFFIX):
+        return
+    entries = _read_journal(path)
+    if entries is None:
+        l.warning('Removing incomplete journal %s', path + JOURNAL_SUFFIX)
+    else:
+        l.warning('Completing changes from journal %s',
+                        path + JOURNAL_SUFFIX)
+        _apply_journal(path, entries)
+    os.remove(path + JOURNAL_SUFFIX)
+
+def _file_id(path):
+    """ Returns the device and inode of the file `path'. """
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino)
+
+def _fsync_directory(path):
+    """ Flushes the directory entries of the directory containing `path'. """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _block_width(group_params):
+    """ Returns the width of a BlockStore for the serialized group
+        parameters `group_params' or None if they are invalid. """
+    if (not isinstance(group_params, list) or not group_params
+            or not isinstance(group_params[0], bytes)):
+        return None
+    return len(group_params[0])
+
+def _packed_block_size(blocks):
+    """ Returns the maximum size of a block of the BlockStore `blocks'
+        when packed with msgpack: an array header and four bin values. """
+    return 1 + 3 * (3 + blocks.width) + 3 + blocks.marker_width
+
+def _pack_blocks(packer, blocks, stream):
+    """ Packs the BlockStore `blocks' with `packer' as a list of blocks.
+        Every PACK_CHUNK_SIZE blocks, the buffer of `packer' is written
+        to `stream' and reset. """
+    packer.pack_array_header(len(blocks))
+    for index, block in enumerate(blocks, 1):
+        packer.pack(block)
+        if index % PACK_CHUNK_SIZE == 0:
+            stream.write(packer.getbuffer())
+            packer.reset()
+
+def _unpack_blocks(unpacker, group_params):
+    """ Unpacks the list of blocks from `unpacker' into a BlockStore.  If
+        the width of the store is not known yet, as `group_params' is
+        None, the blocks are unpacked into a _BlockBuffer instead. """
+    nblocks = unpacker.read_array_header()
+    width = _block_width(group_params)
+    store = (_BlockBuffer() if width is None
+                else pol.blockstore.BlockStore(nblocks, width))
+    for index in range(nblocks):
+        if unpacker.read_array_header() != 4:
+            raise SafeFormatError("A block should have four entries")
+        store[index] = [unpacker.unpack(), unpacker.unpack(),
+                        unpacker.unpack(), unpacker.unpack()]
+    return store
+
+class _BlockBuffer(object):
+    """ Compactly stores blocks of which we do not yet know the width. """
+    def __init__(self):
+        self.values = bytearray()
+        self.lengths = array.array('I')
+    def __setitem__(self, index, block):
+        for value in block:
+            self.values += value
+            self.lengths.append(len(value))
+    def to_blockstore(self, group_params):
+        width = _block_width(group_params)
+        if width is None:
+            raise SafeFormatError("Invalid `group-params' attribute")
+        store = pol.blockstore.BlockStore(len(self.lengths) // 4, width)
+        offset = 0
+        for index in range(len(store)):
+            block = []
+            for length in self.lengths[4*index:4*index+4]:
+                block.append(bytes(self.values[offset:offset+length]))
+                offset += length
+            store[index] = block
+        return store
+
+# Marks a secret in a _LazySecrets that has not been decrypted yet
+_NOT_DECRYPTED = object()
+
+class _LazySecrets(object):
+    """ The list of secrets of a container, of which a secret is only
+        decrypted when it is read.  See `ElGamalSafe._pack_secrets'. """
+    def __init__(self, cipher, cipherstream_key, iv, ct, offset, sizes):
+        self.cipher = cipher
+        self.cipherstream_key = cipherstream_key
+        self.iv = iv
+        self.ct = ct
+        self.secrets = [_NOT_DECRYPTED] * len(sizes)
+        # The start and end of the secrets in `ct'
+        self.spans = []
+        for size in sizes:
+            self.spans.append((offset, offset + size))
+            offset += size
+    def _decrypt(self, index):
+        start, end = self.spans[index]
+        self.secrets[index] = pol.serialization.decode_bytes_in_son(
+                    pol.serialization.string_to_son(_decrypt_range(
+                        self.cipher, self.cipherstream_key, self.iv,
+                        self.ct, start, end)))
+    def __len__(self):
+        return len(self.secrets)
+    def __getitem__(self, index):
+        if self.secrets[index] is _NOT_DECRYPTED:
+            self._decrypt(index)
+        return self.secrets[index]
+    def __setitem__(self, index, secret):
+        self.secrets[index] = secret
+    def __iter__(self):
+        for index in range(len(self.secrets)):
+            yield self[index]
+    def __repr__(self):
+        return repr(list(self))
+    def append(self, secret):
+        self.secrets.append(secret)
+    def records(self):
+        """ Returns the serialized secrets, except those that are None.
+            The secrets that were not read, are not decoded again. """
+        pt = None
+        ret = []
+        for index, secret in enumerate(self.secrets):
+            if secret is None:
+                continue
+            if secret is not _NOT_DECRYPTED:
+                ret.append(pol.serialization.son_to_string(secret))
+                continue
+            if pt is None:
+                pt = _decrypt_range(self.cipher, self.cipherstream_key,
+                                    self.iv, self.ct, 0, len(self.ct))
+            start, end = self.spans[index]
+            ret.append(pt[start:end])
+        return ret
+
+def _decrypt_range(cipher, cipherstream_key, iv, ct, start, end):
+    """ Decrypts ct[start:end] of the ciphertext `ct' of a cipherstream
+        with `cipherstream_key' and `iv'. """
+    aligned_start = start - start % cipher.blocksize
+    return cipher.new_stream(cipherstream_key, iv,
+                offset=aligned_start).decrypt(
+                        bytes(ct[aligned_start:end]))[start - aligned_start:]
+
+def _eg_rerandomize_blocks_initializer(args, kwargs):
     Crypto.Random.atfork()
-def _eg_rerandomize_block(raw_b, g, p):
-    """ Rerandomizes raw_b given group parameters g and p. """
-    s = random.randint(2, int(p))
-    b = [pol.serialization.string_to_number(raw_b[0]),
-         pol.serialization.string_to_number(raw_b[1]),
-         pol.serialization.string_to_number(raw_b[2])]
-    b[0] = (b[0] * pow(g, s, p)) % p
-    b[1] = (b[1] * pow(b[2], s, p)) % p
-    raw_b[0] = pol.serialization.number_to_string(b[0])
-    raw_b[1] = pol.serialization.number_to_string(b[1])
-    return raw_b
+    kwargs['randfunc'] = Crypto.Random.new().read
+
+def _eg_rerandomize_blocks(raw_bs, gp, randfunc):
+    """ Rerandomizes the list of blocks raw_bs given group parameters gp. """
+    p = gp.p
+    table = pol.elgamal.fixed_base_table(gp)
+    string_to_number = pol.serialization.string_to_number
+    number_to_string = pol.serialization.number_to_string
+    for s, raw_b in zip(_eg_random_exponents(len(raw_bs), gp, randfunc),
+                        raw_bs):
+        raw_b[0] = number_to_string(
+                        (string_to_number(raw_b[0]) * table.pow(s)) % p)
+        raw_b[1] = number_to_string(
+                        (string_to_number(raw_b[1])
+                            * gmpy2.powmod(string_to_number(raw_b[2]), s, p))
+                                % p)
+    return raw_bs
+
+def _eg_rerandomize_store(store, gp, randfunc):
+    """ Rerandomizes the blocks in the BlockStore `store' in place. """
+    for index, raw_b in enumerate(_eg_rerandomize_blocks(list(store), gp,
+                                                         randfunc)):
+        store[index] = raw_b
+    return store
+
+def _eg_rerandomize_shared(start_stop, shared, params, gp, randfunc):
+    """ Rerandomizes the blocks [start, stop) of the BlockStore in the
+        pol.parallel.SharedBuffer `shared' in place.  `params' are the
+        number of blocks, width and marker width of the BlockStore. """
+    nblocks, width, marker_width = params
+    store = pol.blockstore.BlockStore(nblocks, width, marker_width,
+                                      shared.buf)
+    _eg_rerandomize_store(store.view(*start_stop), gp, randfunc)
+
+def _eg_random_exponents(n, gp, randfunc):
+    """ Returns `n' random exponents between 2 and p for rerandomization. """
+    p = gp.p
+    # Read the randomness for all exponents at once.  We take 64 bits
+    # more than p has, such that the bias of s mod (p - 1) is negligible.
+    s_size = (gmpy2.num_digits(p, 2) + 7) // 8 + 8
+    rnd = randfunc(s_size * n)
+    return [2 + pol.serialization.string_to_number(
+                    rnd[i*s_size:(i+1)*s_size]) % (p - 1) for i in range(n)]
+
+class RerandomizationFactorPool(object):
+    """ Precomputes, in a background thread, pairs (g^s, pubkey^s) with
+        which blocks of an ElGamalSafe can be rerandomized.
+        See `ElGamalSafe.start_factor_pool'. """
+
+    def __init__(self, safe, max_size):
+        self.safe = safe
+        self.max_size = min(max_size, safe.nblocks)
+        # maps index of block to (pubkey, g^s, pubkey^s)
+        self.factors = {}
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        gp = self.safe.group_params
+        table = pol.elgamal.fixed_base_table(gp)
+        randfunc = Crypto.Random.new().read
+        index = 0
+        while True:
+            with self.cond:
+                while not self.stopped and len(self.factors) >= self.max_size:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                while index in self.factors:
+                    index = (index + 1) % self.safe.nblocks
+            # We do not use `_block_number', as it changes the safe.  If
+            # we get an outdated pubkey, `rerandomize' will notice.
+            with self.safe._blocks_lock:
+                numbers = self.safe._block_numbers.get(index)
+                if numbers is not None and numbers[2] is not None:
+                    pubkey = numbers[2]
+                else:
+                    pubkey = pol.serialization.string_to_number(
+                                    self.safe.data[b'blocks'][index][2])
+            s = _eg_random_exponents(1, gp, randfunc)[0]
+            factor = (pubkey, table.pow(s), gmpy2.powmod(pubkey, s, gp.p))
+            with self.cond:
+                if self.stopped:
+                    return
+                self.factors[index] = factor
+            index = (index + 1) % self.safe.nblocks
+
+    def take(self, indices):
+        """ Removes and returns the factors for the blocks `indices' that
+            have been computed, as a dictionary from index to
+            (pubkey, g^s, pubkey^s). """
+        with self.cond:
+            ret = {}
+            for index in indices:
+                factor = self.factors.pop(index, None)
+                if factor is not None:
+                    ret[index] = factor
+            self.cond.notify()
+            return ret
+
+    def stop(self):
+        """ Stops the background thread and discards the factors. """
+        with self.cond:
+            self.stopped = True
+            self.factors.clear()
+            self.cond.notify()
+        self.thread.join()
 
 TYPE_MAP = {b'elgamal': ElGamalSafe}
@@ -8,6 +8,8 @@ l = logging.getLogger(__name__)
 
 FMT_MSGPACK         = b'\0'
 FMT_ZLIB_MSGPACK    = b'\1'
+# Used by pol.safe for the secrets of a container
+FMT_INDEXED         = b'\2'
 
 # TODO is the format of gmpy2.{to,from}_binary() stable?
 def string_to_number(s):
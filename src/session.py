@@ -13,13 +13,36 @@ class Session(object):
     def unlock(self, password):
         """ Open containers with the given password or increases access
             to an already openend container. """
+        return bool(self.open_containers(password))
+
+    def open_containers(self, password, **kwargs):
+        """ Like `Safe.open_containers', but keeps the containers in the
+            session.  Returns them as a list.
+
+            A container of the session might have been opened before with
+            a password that gives more access.  The container returned
+            only gives the access that `password' gives.  See
+            `LimitedContainer'. """
         # NOTE safe.open_containers will add access to already opened
         #      containers.
-        ok = False
-        for cnt in self.safe.open_containers(password):
+        ret = []
+        for cnt, access in self.safe.open_containers(password,
+                                                with_access=True, **kwargs):
             self._add_container(cnt)
-            ok = True
-        return ok
+            ret.append(_limit(cnt, access))
+        return ret
+
+    def open_containers_many(self, passwords, **kwargs):
+        """ Like `Safe.open_containers_many', but keeps the containers in
+            the session.  As with `open_containers', the containers only
+            give the access their password gives. """
+        ret = []
+        for opened in self.safe.open_containers_many(passwords,
+                                                with_access=True, **kwargs):
+            for cnt, access in opened:
+                self._add_container(cnt)
+            ret.append([_limit(cnt, access) for cnt, access in opened])
+        return ret
 
     @property
     def entries(self):
@@ -37,3 +60,80 @@ class Session(object):
             return
         self._container_set.add(container.id)
         self.containers.append(container)
+
+def _limit(container, access):
+    if access == pol.safe.AS_FULL:
+        return container
+    return LimitedContainer(container, access)
+
+class LimitedContainer(pol.safe.Container):
+    """ A container as seen with `access', either AS_LIST or AS_APPEND,
+        even if it has been opened with a password that gives more. """
+
+    def __init__(self, container, access):
+        self.container = container
+        self.access = access
+
+    def list(self):
+        if self.access == pol.safe.AS_APPEND:
+            raise pol.safe.MissingKey
+        return self._limit_entries(self.container.list())
+    def get(self, key, ignore_case=False):
+        if self.access == pol.safe.AS_APPEND:
+            raise pol.safe.MissingKey
+        return self._limit_entries(self.container.get(key, ignore_case))
+    def _limit_entries(self, entries):
+        # Only the secret key opens the entries of the append slice.
+        return [LimitedEntry(entry) for entry in entries
+                    if not isinstance(entry, pol.safe.ElGamalSafe.AppendEntry)]
+
+    def add(self, key, note, secret):
+        if not self.can_add:
+            raise pol.safe.MissingKey
+        self.container.add(key, note, secret)
+    def save(self):
+        self.container.save()
+
+    @property
+    def can_add(self):
+        # The list and append passwords can only add to the append slice.
+        return self.container.append_data is not None
+    @property
+    def has_secrets(self):
+        return False
+    @property
+    def id(self):
+        return self.container.id
+
+    @property
+    def main_data(self):
+        if self.access == pol.safe.AS_APPEND:
+            return None
+        return self.container.main_data
+    @property
+    def append_data(self):
+        return self.container.append_data
+    @property
+    def secret_data(self):
+        return None
+
+class LimitedEntry(pol.safe.Entry):
+    """ An entry of a LimitedContainer: its secret is hidden. """
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    @property
+    def key(self):
+        return self.entry.key
+    @property
+    def note(self):
+        return self.entry.note
+    @property
+    def has_secret(self):
+        return False
+    @property
+    def secret(self):
+        raise pol.safe.MissingKey
+    def remove(self):
+        raise pol.safe.MissingKey
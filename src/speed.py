@@ -1,37 +1,55 @@
 """ Speed measurements of components of pol """
 
+import io
 import timeit
+import tempfile
 import functools
+import multiprocessing
 
 import pol.kd
 import pol.ks
+import pol.safe
+import pol.blockstore
+import pol.parallel
 import pol.elgamal
 import pol.envelope
 import pol.blockcipher
 
 import Crypto.Random
 
+import gmpy2
+
+def _copy_store(store):
+    store[0] = store[0]
+    return store
+
+def _copy_shared(start_stop, shared, params):
+    nblocks, width, marker_width = params
+    store = pol.blockstore.BlockStore(nblocks, width, marker_width,
+                                      shared.buf).view(*start_stop)
+    store[0] = store[0]
+
 def main(program):
     data = []
     kd = pol.kd.KeyDerivation.setup()
     data.append(('kd.derive (1000x)',
-            timeit.repeat(functools.partial(kd.derive, ['']),
+            timeit.repeat(functools.partial(kd.derive, [b'']),
                                 repeat=3, number=1000)))
 
     ks = pol.ks.KeyStretching.setup()
-    data.append(('ks.stretch', timeit.repeat(functools.partial(ks.stretch, ''),
+    data.append(('ks.stretch', timeit.repeat(functools.partial(ks.stretch, b''),
                                 repeat=3, number=1)))
 
     bs = pol.blockcipher.BlockCipher.setup()
     def bs_encrypt():
-        s = bs.new_stream('!'*32, '!'*16)
-        s.encrypt(' '*20480)
+        s = bs.new_stream(b'!'*32, b'!'*16)
+        s.encrypt(b' '*20480)
     data.append(('blockcipher encrypt (500x 20KB)', timeit.repeat(bs_encrypt,
                                 repeat=3, number=500)))
 
     def bs_decrypt():
-        s = bs.new_stream('!'*32, '!'*16)
-        s.decrypt(' '*20480)
+        s = bs.new_stream(b'!'*32, b'!'*16)
+        s.decrypt(b' '*20480)
     data.append(('blockcipher decrypt (500x 20KB)', timeit.repeat(bs_decrypt,
                                 repeat=3, number=500)))
 
@@ -47,13 +65,20 @@ def main(program):
     gp = pol.elgamal.precomputed_group_params()
     privkey = pol.elgamal.string_to_group(kd([], length=128))
     pubkey = pol.elgamal.pubkey_from_privkey(privkey, gp)
-    c1, c2 = pol.elgamal.encrypt('!'*128, pubkey, gp, 128, randfunc)
+    c1, c2 = pol.elgamal.encrypt(b'!'*128, pubkey, gp, 128, randfunc)
+    table = pol.elgamal.fixed_base_table(gp)
+    data.append(('EG g^x with gmpy2.powmod (100x)',
+            timeit.repeat(functools.partial(gmpy2.powmod, gp.g, privkey, gp.p),
+                            repeat=3, number=100)))
+    data.append(('EG g^x with fixed-base table (100x)',
+            timeit.repeat(functools.partial(table.pow, privkey),
+                            repeat=3, number=100)))
     data.append(('EG pubkey_from_privkey (100x)',
             timeit.repeat(functools.partial(pol.elgamal.pubkey_from_privkey,
                             privkey, gp), repeat=3, number=100)))
     data.append(('EG encrypt (100x)',
             timeit.repeat(functools.partial(pol.elgamal.encrypt,
-                                '!'*128, pubkey, gp, 128, randfunc),
+                                b'!'*128, pubkey, gp, 128, randfunc),
                             repeat=3, number=100)))
     data.append(('EG decrypt (100x)',
             timeit.repeat(functools.partial(pol.elgamal.decrypt,
@@ -62,9 +87,9 @@ def main(program):
 
     data.append(('string_to_number (10000x)',
             timeit.repeat(functools.partial(pol.serialization.string_to_number,
-                            '!'*128), repeat=3, number=10000)))
+                            b'!'*128), repeat=3, number=10000)))
 
-    number = pol.serialization.string_to_number('!'*128)
+    number = pol.serialization.string_to_number(b'!'*128)
     data.append(('number_to_string (10000x)',
             timeit.repeat(functools.partial(pol.serialization.number_to_string,
                             number), repeat=3, number=10000)))
@@ -78,15 +103,115 @@ def main(program):
             timeit.repeat(envelope.generate_keypair,
                             repeat=3, number=50)))
     pubkey, privkey = envelope.generate_keypair()
-    msg = envelope.seal('!', pubkey)
+    msg = envelope.seal(b'!', pubkey)
     data.append(('envelope seal (50x)',
-            timeit.repeat(functools.partial(envelope.seal, '!'*128, pubkey), 
+            timeit.repeat(functools.partial(envelope.seal, b'!'*128, pubkey), 
                             repeat=3, number=50)))
     data.append(('envelope open (50x)',
             timeit.repeat(functools.partial(envelope.open, msg, privkey), 
                             repeat=3, number=50)))
 
 
+    safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=1)
+    safe._write_block(0, safe._eg_encrypt_block(b'key', 0, b'!'*128,
+                                randfunc, annex=True))
+    data.append(('safe.group_params (10000x)',
+            timeit.repeat(lambda: safe.group_params, repeat=3, number=10000)))
+    data.append(('safe._eg_decrypt_block (100x)',
+            timeit.repeat(functools.partial(safe._eg_decrypt_block, b'key', 0),
+                            repeat=3, number=100)))
+
+    # Time to open a large safe in either format.  The contents of the
+    # blocks do not matter for this, so we fill them with random data.
+    safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=32768)
+    blocks = safe.data[b'blocks']
+    for index in range(len(blocks)):
+        blocks[index] = [randfunc(129), randfunc(129), randfunc(129),
+                            randfunc(32)]
+    for fmt in pol.safe.FORMATS:
+        with tempfile.NamedTemporaryFile() as f:
+            safe.format = fmt
+            safe.store_to_stream(f)
+            f.flush()
+            def load():
+                with open(f.name, 'rb') as g:
+                    pol.safe.Safe.load_from_stream(g, None, False)
+            data.append(('open 32768 block safe (%s format)' % fmt,
+                    timeit.repeat(load, repeat=3, number=1)))
+
+    # Throughput of packing and unpacking safes in the msgpack format
+    for n_blocks in (1024, 8192, 32768):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=n_blocks)
+        safe.format = pol.safe.FORMAT_MSGPACK
+        safe.data[b'blocks'] = blocks.take(range(n_blocks))
+        f = io.BytesIO()
+        safe.store_to_stream(f)
+        def pack():
+            safe.store_to_stream(io.BytesIO())
+        def unpack():
+            f.seek(0)
+            pol.safe.Safe.load_from_stream(f, None, False)
+        data.append(('pack %s block safe (msgpack format)' % n_blocks,
+                timeit.repeat(pack, repeat=3, number=1)))
+        data.append(('unpack %s block safe (msgpack format)' % n_blocks,
+                timeit.repeat(unpack, repeat=3, number=1)))
+
+    # Overhead of a call to parallel_map versus a call on a WorkerPool
+    for use_threads in (False, True):
+        kind = 'threads' if use_threads else 'processes'
+        data.append(('parallel_map, 2 %s (20x)' % kind,
+                timeit.repeat(functools.partial(pol.parallel.parallel_map,
+                                abs, range(2), chunk_size=1, nworkers=2,
+                                use_threads=use_threads),
+                            repeat=3, number=20)))
+        pool = pol.parallel.WorkerPool(2, use_threads)
+        pool.map(abs, range(2), chunk_size=1)
+        data.append(('WorkerPool.map, 2 %s (20x)' % kind,
+                timeit.repeat(functools.partial(pool.map, abs, range(2),
+                                                chunk_size=1),
+                            repeat=3, number=20)))
+        pool.close()
+
+    # A safe of which every block is in use
+    safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=4096)
+    safe.trash_freespace()
+    blocks = safe.data[b'blocks']
+    params = (len(blocks), blocks.width, blocks.marker_width)
+    chunks = [(i, i + pol.safe.RERANDOMIZE_CHUNK_SIZE) for i in
+                range(0, len(blocks), pol.safe.RERANDOMIZE_CHUNK_SIZE)]
+    pool = pol.parallel.WorkerPool(2)
+    def via_queue():
+        views = [blocks.view(start, stop) for start, stop in chunks]
+        for view, new_view in zip(views, pool.map(_copy_store, views)):
+            view.region()[:] = new_view.region()
+    data.append(('4096 blocks to workers via queue',
+            timeit.repeat(via_queue, repeat=3, number=1)))
+    if pol.parallel.have_shared_memory:
+        def via_shared_memory():
+            shared = pol.parallel.SharedBuffer(len(blocks.region()))
+            shared.buf[:] = blocks.region()
+            pool.map(_copy_shared, chunks, args=(shared, params))
+            blocks.region()[:] = shared.buf
+            shared.close()
+            shared.unlink()
+        data.append(('4096 blocks to workers via shared memory',
+                timeit.repeat(via_shared_memory, repeat=3, number=1)))
+    pool.close()
+
+    nworkers = 1
+    while True:
+        safe.close()
+        safe.nworkers = nworkers
+        data.append(('find_slices 4096 blocks (%s workers)' % nworkers,
+                timeit.repeat(lambda: list(safe._find_slices(b'key')),
+                                repeat=3, number=1)))
+        data.append(('rerandomize 4096 blocks (%s workers)' % nworkers,
+                timeit.repeat(functools.partial(safe.rerandomize, nworkers),
+                                repeat=3, number=1)))
+        if nworkers >= multiprocessing.cpu_count():
+            break
+        nworkers = min(2 * nworkers, multiprocessing.cpu_count())
+    safe.close()
 
     for desc, res in data:
         print('%-40s %.4f %.4f %.4f' % (desc, res[0], res[1], res[2]))
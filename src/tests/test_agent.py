@@ -0,0 +1,82 @@
+import os
+import shutil
+import unittest
+import tempfile
+import threading
+
+import pol.safe
+import pol.agent
+
+class TestAgent(unittest.TestCase):
+    def test_agent(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'agent.sock')
+            safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
+            safe.new_container(b'm', b'l', b'a', nblocks=70)
+            saves = []
+            agent = pol.agent.Agent(safe, path, lambda: saves.append(None), 0,
+                                    safe_path=os.path.join(d, 'safe.pol'))
+            agent.bind()
+            thread = threading.Thread(target=agent.serve)
+            thread.start()
+            try:
+                client = pol.agent.Client(path)
+                self.assertEqual(client.safe_path(),
+                                 os.path.realpath(os.path.join(d, 'safe.pol')))
+                self.assertEqual(client.open_containers(b'wrong'), [])
+                containers = client.open_containers(b'm')
+                self.assertEqual(len(containers), 1)
+                container = containers[0]
+                self.assertTrue(container.can_add)
+                container.add('key', 'note', 'secret')
+                container.save()
+                self.assertEqual([(e.key, e.note) for e in container.list()],
+                                 [('key', 'note')])
+                entries = container.get('key')
+                self.assertEqual(len(entries), 1)
+                self.assertEqual(entries[0].secret, 'secret')
+                self.assertEqual(container.get('other'), [])
+                # Another client has to open the container itself and only
+                # gets the access its password gives.
+                client2 = pol.agent.Client(path)
+                with self.assertRaises(pol.agent.AgentError):
+                    client2.call('list', container.id)
+                container2 = client2.open_containers(b'l')[0]
+                self.assertEqual(container2.id, container.id)
+                entries = container2.get('key')
+                self.assertEqual(len(entries), 1)
+                self.assertFalse(entries[0].has_secret)
+                with self.assertRaises(pol.safe.MissingKey):
+                    entries[0].secret
+                client2.close()
+                client3 = pol.agent.Client(path)
+                container3 = client3.open_containers(b'a')[0]
+                self.assertTrue(container3.can_add)
+                with self.assertRaises(pol.safe.MissingKey):
+                    container3.list()
+                with self.assertRaises(pol.safe.MissingKey):
+                    container3.get('key')
+                container3.add('key2', 'note2', 'secret2')
+                # ... but more access once it gives another password
+                container3 = client3.open_containers(b'm')[0]
+                self.assertEqual(len(container3.list()), 2)
+                self.assertEqual(container3.get('key')[0].secret, 'secret')
+                client3.close()
+                client.stop()
+                client.close()
+            finally:
+                agent.stop()
+                thread.join()
+            self.assertTrue(saves)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(d)
+    def test_remote_entry(self):
+        entry = pol.agent.RemoteEntry('key', 'note', None, False)
+        with self.assertRaises(pol.safe.MissingKey):
+            entry.secret
+
+
+if __name__ == '__main__':
+    unittest.main()
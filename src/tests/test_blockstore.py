@@ -0,0 +1,67 @@
+import pickle
+import unittest
+
+import pol.blockstore
+
+class TestBlockStore(unittest.TestCase):
+    def test_blockstore(self):
+        blocks = [[b'', b'', b'', b''],
+                  [b'a', b'bc', b'\0d\0', b'e' * 32],
+                  [b'x' * 10, b'', b'y', b'']]
+        store = pol.blockstore.BlockStore.from_list(blocks, 10)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(list(store), blocks)
+        self.assertEqual(store[1], blocks[1])
+        self.assertEqual(store[-1], blocks[2])
+        self.assertEqual(store[1:], blocks[1:])
+        store[0] = [b'1', b'2', b'3', b'4']
+        self.assertEqual(store[0], [b'1', b'2', b'3', b'4'])
+        # Changing a returned block does not change the store
+        store[0][0] = b'5'
+        self.assertEqual(store[0][0], b'1')
+        self.assertEqual(len(store.region()), 3 * store.record_size)
+        with self.assertRaises(ValueError):
+            store[0] = [b'x' * 11, b'', b'', b'']
+        with self.assertRaises(ValueError):
+            store[0] = [b'', b'', b'', b'x' * 33]
+        with self.assertRaises(IndexError):
+            store[3]
+    def test_buffer(self):
+        buf = bytearray(b'!' * 3)
+        with self.assertRaises(ValueError):
+            pol.blockstore.BlockStore(1, 10, buf=buf)
+        store = pol.blockstore.BlockStore(1, 10)
+        buf = bytearray(b'!' * 3) + store.buf
+        store2 = pol.blockstore.BlockStore(1, 10, buf=buf, offset=3)
+        store2[0] = [b'1', b'2', b'3', b'4']
+        self.assertEqual(buf[:3], b'!!!')
+        self.assertEqual(store2[0], [b'1', b'2', b'3', b'4'])
+    def test_view_take_put(self):
+        blocks = [[str(i).encode(), b'', b'', b'm%d' % i if i % 2 else b'']
+                        for i in range(5)]
+        store = pol.blockstore.BlockStore.from_list(blocks, 10)
+        self.assertEqual(list(store.markers()),
+                         [b'', b'm1', b'', b'm3', b''])
+        view = store.view(1, 3)
+        self.assertEqual(list(view), blocks[1:3])
+        view[0] = [b'a', b'b', b'c', b'd']
+        self.assertEqual(store[1], [b'a', b'b', b'c', b'd'])
+        with self.assertRaises(IndexError):
+            store.view(3, 6)
+        # A pickled view contains only its own blocks
+        view2 = pickle.loads(pickle.dumps(view))
+        self.assertEqual(len(view2.buf), 2 * view.record_size)
+        self.assertEqual(list(view2), list(view))
+        taken = store.take([4, -1, 0])
+        self.assertEqual(list(taken), [blocks[4], blocks[4], blocks[0]])
+        taken[1] = [b'x', b'y', b'z', b'']
+        self.assertEqual(store[4], blocks[4])
+        store.put([2, 3], taken.view(1, 3))
+        self.assertEqual(store[2], [b'x', b'y', b'z', b''])
+        self.assertEqual(store[3], blocks[0])
+        with self.assertRaises(ValueError):
+            store.put([0], taken)
+
+
+if __name__ == '__main__':
+    unittest.main()
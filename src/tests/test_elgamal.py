@@ -36,6 +36,24 @@ for bits in (128, 256, 512):
         return lambda self: self._test_generated_group_parameters(bits)
     setattr(TestGeneratedGroupParameters, 'test_%s' % bits, ch(bits))
 
+class TestFixedBaseTable(unittest.TestCase):
+    def test_pow(self):
+        gp = pol.elgamal.precomputed_group_params(1025)
+        table = pol.elgamal.fixed_base_table(gp)
+        self.assertTrue(table is pol.elgamal.fixed_base_table(gp))
+        rnd = gmpy2.random_state()
+        for x in [0, 1, 2, 63, 64, 65, gp.p - 1, gp.p, gp.p + 1, gp.p ** 2] + [
+                    gmpy2.mpz_random(rnd, gp.p) for i in range(50)]:
+            self.assertEqual(pol.elgamal.pow_g(x, gp), pow(gp.g, x, gp.p))
+    def test_window(self):
+        gp = pol.elgamal.precomputed_group_params(1025)
+        rnd = gmpy2.random_state()
+        for window in (1, 4, 7, 8):
+            table = pol.elgamal.FixedBaseTable(gp.g, gp.p, 1025, window)
+            for i in range(10):
+                x = gmpy2.mpz_random(rnd, gp.p)
+                self.assertEqual(table.pow(x), pow(gp.g, x, gp.p))
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -50,6 +50,17 @@ class TestSHA(unittest.TestCase):
                 b'996059a8fe87e36dde9c60b1e3838d5a891d023f58b73667672d3b796224e'+
                 b'6b7c617bb6b20a9c08b49f40f9b37f5f34be841e957e415638b6cc03cb4c5'+
                 b'2906044e65e5')
+    def test_derive_many(self):
+        kd = pol.kd.KeyDerivation.setup({b'bits': 256, b'type': b'sha',b'salt':b'c'})
+        suffixes = [b'', b'c', b'xyz']
+        for length in (13, 32, 64, 128):
+            self.assertEqual(kd.derive_many([b'a', b'b'], suffixes, length),
+                        [kd([b'a', b'b', x], length) for x in suffixes])
+        self.assertEqual(kd.derive_many([], [b'ab']), [kd([b'ab'])])
+        with self.assertRaises(TypeError):
+            kd.derive_many(['a'], [b'b'])
+        with self.assertRaises(TypeError):
+            kd.derive_many([b'a'], [b'b', 2])
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import time
 import unittest
 import binascii
 
@@ -48,6 +49,35 @@ class TestArgon2(unittest.TestCase):
                    (b'96f5ba079ff69cb9a0eecc16399a2d12fab4d7b7fd1591c1b5b14d59c9'
                     b'498a7f9598c6912d970ca7db619177cc22be83996bdf5a480a346c33c8'
                     b'857e7578fc61'))
+class TestKeyStretchingCache(unittest.TestCase):
+    def test_cache(self):
+        ks = pol.ks.KeyStretching.setup({
+            b'type': b'argon2', b't': 1, b'm':8, b'p':1, b'salt': b'waasdasdaa'})
+        ks2 = pol.ks.KeyStretching.setup({
+            b'type': b'argon2', b't': 1, b'm':8, b'p':1, b'salt': b'waasdasdab'})
+        stretched = []
+        def stretch(password):
+            stretched.append(password)
+            return pol.ks.Argon2KeyStretching.stretch(ks, password)
+        ks.stretch = stretch
+        cache = pol.ks.KeyStretchingCache(0.2)
+        key = cache.stretch(ks, b'abc')
+        self.assertEqual(key, pol.ks.Argon2KeyStretching.stretch(ks, b'abc'))
+        self.assertEqual(cache.stretch(ks, b'abc'), key)
+        self.assertEqual(stretched, [b'abc'])
+        self.assertNotEqual(cache.stretch(ks, b'abd'), key)
+        self.assertNotEqual(cache.stretch(ks2, b'abc'), key)
+        self.assertEqual(len(cache), 3)
+        # The keys are forgotten when they expire ...
+        time.sleep(0.5)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stretch(ks, b'abc'), key)
+        self.assertEqual(stretched, [b'abc', b'abd', b'abc'])
+        # ... or when the cache is cleared.
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stretch(ks, b'abc'), key)
+        self.assertEqual(stretched, [b'abc', b'abd', b'abc', b'abc'])
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,14 @@
+import io
 import os
+import sys
 import unittest
+import shutil
 import tempfile
+import threading
+import unittest.mock
+
+import pol.safe
+import pol.agent
 
 import pol.cli
 
@@ -32,6 +40,74 @@ class TestMain(unittest.TestCase):
         self.assertEqual(self.pol('list', '-p', 'b'), 0)
         self.assertEqual(self.pol('touch'), 0)
         self.assertEqual(self.pol('export', '-p', 'a'), 0)
+        self.assertEqual(self.pol('convert', '--to', 'msgpack'), 0)
+        self.assertEqual(self.pol('get', '-p', 'b', 'key'), -4)
+        self.assertEqual(self.pol('convert'), 0)
+        self.assertEqual(self.pol('get', '-p', 'b', 'key'), -4)
+    def test_shell(self):
+        self.pol('init', '-P', '-p', 'a', 'b', 'c', '-f',
+                    '--i-know-its-unsafe', '-N', '128')
+        stdin = sys.stdin
+        sys.stdin = io.StringIO('put -p a -s "a secret" key\n'
+                                'get -p a key\n'
+                                'save\n'
+                                'list -p a\n')
+        try:
+            with unittest.mock.patch.object(pol.safe, 'open',
+                                    wraps=pol.safe.open) as safe_open:
+                self.assertEqual(self.pol('shell'), 0)
+            # The safe is opened only once
+            self.assertEqual(safe_open.call_count, 1)
+        finally:
+            sys.stdin = stdin
+        self.assertEqual(self.pol('get', '-p', 'a', 'key'), 0)
+        self.assertEqual(self.pol('save'), 0)
+    def _shell(self, commands):
+        """ Runs `commands' in `pol shell' and returns its output. """
+        stdin, stdout = sys.stdin, sys.stdout
+        sys.stdin = io.StringIO(commands)
+        sys.stdout = io.StringIO()
+        try:
+            self.assertEqual(self.pol('shell'), 0)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+    def test_shell_access(self):
+        self.pol('init', '-P', '-p', 'a', 'b', 'c', '-f',
+                    '--i-know-its-unsafe', '-N', '128')
+        self.assertEqual(self.pol('put', '-p', 'a', '-s', 'a secret', 'key'),
+                            0)
+        self.assertIn('a secret', self._shell('get -p a key\n'))
+        # The list password does not give access to the secret, even if
+        # the master password opened the container before.
+        self.assertNotIn('a secret', self._shell('list -p a\n'
+                                                 'get -p b key\n'))
+    def test_agent(self):
+        self.pol('init', '-P', '-p', 'a', 'b', 'c', '-f',
+                    '--i-know-its-unsafe', '-N', '128')
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        path = os.path.join(d, 'agent.sock')
+        with pol.safe.open(self.safe.name) as safe:
+            agent = pol.agent.Agent(safe, path, lambda: None, 0,
+                                    safe_path=self.safe.name)
+            agent.bind()
+            thread = threading.Thread(target=agent.serve)
+            thread.start()
+            try:
+                # The safe is locked: these only work through the agent.
+                with unittest.mock.patch.dict(os.environ,
+                                    {pol.agent.SOCKET_ENV_VAR: path}):
+                    self.assertEqual(self.pol('put', '-p', 'a', '-s',
+                                              'a secret', 'key'), 0)
+                    self.assertEqual(self.pol('generate', '-p', 'a', '-s',
+                                              'key2'), 0)
+                container = list(safe.open_containers(b'a'))[0]
+                self.assertEqual(sorted(e.key for e in container.list()),
+                                 ['key', 'key2'])
+            finally:
+                agent.stop()
+                thread.join()
     def test_cracktime_names(self):
         self.assertEqual(frozenset(pol.cli.cracktime_names),
                          frozenset(list(pol.cli.cracktimes.keys())))
@@ -0,0 +1,190 @@
+import time
+import unittest
+import threading
+
+import pol.parallel
+
+class Shared(object):
+    def __init__(self):
+        self.value = 1
+    def add(self, x):
+        return x + self.value
+
+def _square(x, offset=0):
+    return x * x + offset
+
+def _fail(x):
+    if x == 3:
+        raise ValueError(x)
+    return x
+
+class _UnpicklableError(Exception):
+    def __init__(self, x):
+        super(_UnpicklableError, self).__init__(x)
+        self.lock = threading.Lock()
+
+def _fail_unpicklable(x):
+    if x == 3:
+        raise _UnpicklableError(x)
+    return x
+
+def _sleep(x):
+    time.sleep(0.01)
+    return x
+
+def _slow_start(x, calls=[]):
+    # Only the first call is slow, like a function that builds a table
+    if not calls:
+        time.sleep(0.2)
+    calls.append(x)
+    return x
+
+def _reverse_shared(start_stop, shared):
+    buf = shared.buf
+    start, stop = start_stop
+    buf[start:stop] = bytes(buf[start:stop])[::-1]
+
+def _initializer(args, kwargs):
+    kwargs['offset'] = 1
+
+def _failing_initializer(args, kwargs):
+    raise ValueError
+
+def _ident_initializer(args, kwargs):
+    kwargs['ident'] = threading.get_ident()
+
+def _check_ident(x, ident):
+    time.sleep(0.001)
+    return ident == threading.get_ident()
+
+class TestWorkerPool(unittest.TestCase):
+    def _test_pool(self, use_threads):
+        shared = Shared()
+        pool = pol.parallel.WorkerPool(2, use_threads, shared=(shared,))
+        try:
+            self.assertEqual(pool.map(_square, range(10), chunk_size=3),
+                                [x * x for x in range(10)])
+            self.assertEqual(pool.map(_square, range(10), chunk_size=1,
+                                      initializer=_initializer),
+                                [x * x + 1 for x in range(10)])
+            # The workers are reused
+            workers = list(pool.workers)
+            self.assertEqual(pool.map(shared.add, range(5), chunk_size=1),
+                                list(range(1, 6)))
+            self.assertEqual(pool.workers, workers)
+            # ... until the shared objects change
+            shared.value = 2
+            pool.invalidate()
+            self.assertEqual(pool.map(shared.add, range(5), chunk_size=1),
+                                list(range(2, 7)))
+            self.assertEqual(pool.workers == workers, use_threads)
+            # Exceptions are passed on
+            with self.assertRaises(ValueError):
+                pool.map(_fail, range(10), chunk_size=1)
+            # ... also those that cannot be pickled
+            with self.assertRaises(_UnpicklableError if use_threads
+                                        else RuntimeError):
+                pool.map(_fail_unpicklable, range(10), chunk_size=1)
+            self.assertEqual(pool.map(_fail, range(3), chunk_size=1),
+                                list(range(3)))
+        finally:
+            pool.close()
+        self.assertEqual(pool.workers, [])
+        with self.assertRaises(pol.parallel.WorkerPoolClosedError):
+            pool.map(_square, range(10))
+    def test_processes(self):
+        self._test_pool(False)
+    def test_threads(self):
+        self._test_pool(True)
+    def test_adaptive_chunks(self):
+        pool = pol.parallel.WorkerPool(2, True)
+        try:
+            # Cheap work is done without starting workers
+            self.assertEqual(pool.map(_square, range(100), chunk_size=None,
+                                      initializer=_initializer),
+                                [x * x + 1 for x in range(100)])
+            self.assertEqual(pool.workers, [])
+            # ... also if the first element is slow
+            self.assertEqual(pool.map(_slow_start, range(100),
+                                      chunk_size=None), list(range(100)))
+            self.assertEqual(pool.workers, [])
+            self.assertEqual(pool.map(_sleep, range(20), chunk_size=None),
+                                list(range(20)))
+            self.assertEqual(len(pool.workers), 2)
+        finally:
+            pool.close()
+
+class TestParallelMap(unittest.TestCase):
+    def test_adaptive_chunks(self):
+        for use_threads in (False, True):
+            self.assertEqual(pol.parallel.parallel_map(_sleep, range(20),
+                                chunk_size=None, nworkers=2,
+                                use_threads=use_threads),
+                             list(range(20)))
+            self.assertEqual(pol.parallel.parallel_map(_square, range(100),
+                                args=(1,), chunk_size=None, nworkers=2,
+                                use_threads=use_threads),
+                             [x * x + 1 for x in range(100)])
+    def test_exceptions(self):
+        for use_threads in (False, True):
+            with self.assertRaises(ValueError):
+                pol.parallel.parallel_map(_fail, range(10), nworkers=2,
+                                          use_threads=use_threads)
+            with self.assertRaises(ValueError):
+                pol.parallel.parallel_map(_square, range(10), nworkers=2,
+                                initializer=_failing_initializer,
+                                use_threads=use_threads)
+            # Also the threads pass on their results through a
+            # multiprocessing.Queue.
+            with self.assertRaises(RuntimeError):
+                pol.parallel.parallel_map(_fail_unpicklable, range(10),
+                                nworkers=2, use_threads=use_threads)
+    def test_initializer_kwargs(self):
+        # Every worker thread gets its own kwargs and the caller's are
+        # left alone, also if there is only one chunk.
+        kwargs = {}
+        for n in (20, 1):
+            self.assertTrue(all(pol.parallel.parallel_map(_check_ident,
+                                range(n), kwargs=kwargs, nworkers=2,
+                                initializer=_ident_initializer,
+                                use_threads=True)))
+        pool = pol.parallel.WorkerPool(2, True)
+        try:
+            self.assertTrue(all(pool.map(_check_ident, range(1),
+                                kwargs=kwargs,
+                                initializer=_ident_initializer)))
+        finally:
+            pool.close()
+        self.assertEqual(kwargs, {})
+    def test_plan_chunks(self):
+        ys, chunks = pol.parallel._plan_chunks(_sleep, range(100), (), {},
+                                            None, 4, 0.001, 0.0001)
+        # Workers are only planned for after a second measurement.
+        self.assertEqual(ys, [0, 1, 2])
+        self.assertEqual(chunks[0], (3, 12))
+        self.assertEqual(sum(size for i, size in chunks), 97)
+        self.assertTrue(all(chunks[i][0] + chunks[i][1] == chunks[i+1][0]
+                                for i in range(len(chunks) - 1)))
+        self.assertEqual(chunks[-1][1], 1)
+
+
+@unittest.skipUnless(pol.parallel.have_shared_memory, "requires shared_memory")
+class TestSharedBuffer(unittest.TestCase):
+    def test_buffer(self):
+        shared = pol.parallel.SharedBuffer(100)
+        pool = pol.parallel.WorkerPool(2)
+        try:
+            shared.buf[:] = bytes(range(100))
+            pool.map(_reverse_shared, [(i, i + 10) for i in range(0, 100, 10)],
+                        args=(shared,))
+            self.assertEqual(bytes(shared.buf),
+                    b''.join(bytes(range(i, i + 10))[::-1]
+                                for i in range(0, 100, 10)))
+        finally:
+            pool.close()
+            shared.close()
+            shared.unlink()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,25 @@
+import io
+import os
+import shutil
 import unittest
+import unittest.mock
+import time
+import tempfile
 
 import Crypto.Random
+import msgpack
 
 import pol.safe
+import pol.blockstore
+import pol.serialization
+
+_builtin_open = open
+
+def _msgpack_default(obj):
+    # Packs the blocks as the plain msgpack format has them.
+    if isinstance(obj, pol.blockstore.BlockStore):
+        return list(obj)
+    raise TypeError("Cannot serialize %r" % obj)
 
 class TestElgamalSafe(unittest.TestCase):
     def test_generate(self):
@@ -44,6 +61,296 @@ class TestElgamalSafe(unittest.TestCase):
         sl3.store(b'key3', b'!!!!', annex=True)
         self.assertFalse(list(safe._find_slices(b'nokey')))
         self.assertEqual(len(list(safe._find_slices(b'key'))), 2)
+    def test_find_slices_parallel(self):
+        for use_threads in (False, True):
+            safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=600,
+                                nworkers=2, use_threads=use_threads)
+            sl1 = safe._new_slice(2)
+            sl2 = safe._new_slice(2)
+            sl3 = safe._new_slice(2)
+            sl1.store(b'key', b'!!!!', annex=True)
+            sl2.store(b'key', b'????', annex=True)
+            sl3.store(b'key3', b'!!!!', annex=True)
+            self.assertFalse(list(safe._find_slices(b'nokey')))
+            sls = list(safe._find_slices(b'key'))
+            self.assertEqual([sl.first_index for sl in sls],
+                        sorted([sl1.first_index, sl2.first_index]))
+    def test_pool_stale_blocks(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=150,
+                            nworkers=2, use_threads=False)
+        self.addCleanup(safe.close)
+        sl = safe._new_slice(150)
+        sl.store(b'key', b'!!!!', annex=True)
+        self.assertEqual(safe._load_slice(b'key', sl.first_index).value,
+                         b'!!!!')
+        workers = list(safe.pool.workers)
+        self.assertTrue(workers)
+        # The workers are not started again for changed blocks ...
+        sl.store(b'key2', b'????', annex=True)
+        self.assertEqual(safe._load_slice(b'key2', sl.first_index).value,
+                         b'????')
+        self.assertEqual(safe.pool.workers, workers)
+        # ... unless there are many.
+        safe._blocks_changed(range(pol.safe.POOL_MAX_STALE_BLOCKS + 1))
+        self.assertEqual(safe._load_slice(b'key2', sl.first_index).value,
+                         b'????')
+        self.assertNotEqual(safe.pool.workers, workers)
+    def test_pool_stale_blocks_fork(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10,
+                            nworkers=2, use_threads=False)
+        self.addCleanup(safe.close)
+        # Workers started after a change have it already
+        safe._blocks_changed([0])
+        safe.pool.map(abs, range(4))
+        self.assertTrue(safe.pool.workers)
+        self.assertEqual(safe._pool_stale_blocks, set())
+    def test_marker_index(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        sl1 = safe._new_slice(2)
+        sl1.store(b'key', b'!!!!', annex=True)
+        self.assertEqual(len(list(safe._find_slices(b'key'))), 1)
+        self.assertEqual(len(safe._get_marker_index()), 2)
+        sl2 = safe._new_slice(2)
+        sl2.store(b'key', b'!!!!', annex=True)
+        self.assertEqual(len(safe._get_marker_index()), 4)
+        self.assertEqual(len(list(safe._find_slices(b'key'))), 2)
+        sl1.store(b'key2', b'!!!!', annex=True)
+        self.assertEqual(len(safe._get_marker_index()), 4)
+        self.assertEqual(len(list(safe._find_slices(b'key'))), 1)
+        safe.rerandomize()
+        self.assertEqual(len(list(safe._find_slices(b'key'))), 1)
+        self.assertEqual(len(list(safe._find_slices(b'key2'))), 1)
+    def test_rerandomize(self):
+        # With enough blocks, worker processes get them in shared memory.
+        for use_threads, n_blocks in ((False, 150), (True, 150),
+                    (False, pol.safe.RERANDOMIZE_SHARED_MEMORY_MIN_BLOCKS)):
+            safe = pol.safe.Safe.generate(precomputed_gp=True,
+                                n_blocks=n_blocks, nworkers=2,
+                                use_threads=use_threads)
+            sl = safe._new_slice(n_blocks)
+            randfunc = Crypto.Random.new().read
+            data = randfunc(sl.size)
+            sl.store(b'key', data, annex=True)
+            safe.sync_blocks()
+            old_blocks = [list(b) for b in safe.data[b'blocks']]
+            safe.rerandomize(nworkers=2, use_threads=use_threads)
+            for old_b, b in zip(old_blocks, safe.data[b'blocks']):
+                self.assertNotEqual(old_b[:2], b[:2])
+                self.assertEqual(old_b[2:], b[2:])
+            self.assertEqual(safe._load_slice(b'key', sl.first_index).value,
+                                data)
+            safe.close()
+    def test_rerandomize_fraction(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=100)
+        sl = safe._new_slice(1)
+        safe.trash_freespace()
+        safe.rerandomize()
+        sl.store(b'key', b'!!!!', annex=True)
+        changed = set()
+        for i in range(4):
+            old_blocks = [list(b) for b in safe.data[b'blocks']]
+            safe.rerandomize(fraction=0.3)
+            now_changed = set(index for index in range(100)
+                    if old_blocks[index] != safe.data[b'blocks'][index])
+            if i == 0:
+                self.assertIn(sl.first_index, now_changed)
+                self.assertIn(len(now_changed), (30, 31))
+            else:
+                self.assertEqual(len(now_changed), 30)
+            changed.update(now_changed)
+        self.assertEqual(len(changed), 100)
+        self.assertEqual(safe._load_slice(b'key', sl.first_index).value,
+                            b'!!!!')
+    def test_factor_pool(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=20)
+        sl = safe._new_slice(1)
+        sl.store(b'key', b'!!!!', annex=True)
+        safe.trash_freespace()
+        safe.start_factor_pool()
+        pool = safe._factor_pool
+        for i in range(1000):
+            with pool.cond:
+                if len(pool.factors) == 20:
+                    break
+            time.sleep(0.01)
+        # Changes the public key: the precomputed factor must be skipped.
+        sl.store(b'key2', b'????', annex=True)
+        old_blocks = [list(b) for b in safe.data[b'blocks']]
+        safe.rerandomize()
+        self.assertTrue(all(old_blocks[i] != safe.data[b'blocks'][i]
+                                for i in range(20) if old_blocks[i][0]))
+        self.assertEqual(safe._load_slice(b'key2', sl.first_index).value,
+                            b'????')
+        safe.close()
+        self.assertFalse(pool.thread.is_alive())
+        self.assertEqual(pool.factors, {})
+        self.assertIsNone(safe._factor_pool)
+    def test_block_numbers(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=20)
+        sl = safe._new_slice(2)
+        old_blocks = list(safe.data[b'blocks'])
+        sl.store(b'key', b'!!!!', annex=True)
+        # The blocks are only kept as numbers ...
+        self.assertEqual(safe._unsynced_blocks, set(sl.indices))
+        self.assertEqual(safe.data[b'blocks'][sl.first_index][:3],
+                            old_blocks[sl.first_index][:3])
+        self.assertEqual(safe._load_slice(b'key', sl.first_index).value,
+                            b'!!!!')
+        # ... until they are stored.
+        safe.store_to_stream(io.BytesIO())
+        self.assertEqual(safe._unsynced_blocks, set())
+        safe._block_numbers = {}
+        self.assertEqual(safe._load_slice(b'key', sl.first_index).value,
+                            b'!!!!')
+        safe.close()
+    def test_formats(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=20)
+        # Older versions of pol cannot read the fixed format
+        self.assertEqual(safe.format, pol.safe.FORMAT_MSGPACK)
+        sl = safe._new_slice(5)
+        sl.store(b'key', b'!!!!', annex=True)
+        safe.sync_blocks()
+        blocks = list(safe.data[b'blocks'])
+        for fmt in pol.safe.FORMATS:
+            safe.format = fmt
+            # Load once from memory and once from a file, which is mapped
+            f = io.BytesIO()
+            safe.store_to_stream(f)
+            with tempfile.TemporaryFile() as tf:
+                tf.write(f.getvalue())
+                for stream in (f, tf):
+                    stream.seek(0)
+                    safe2 = pol.safe.Safe.load_from_stream(stream, None, False)
+                    self.assertEqual(safe2.format, fmt)
+                    self.assertEqual(list(safe2.data[b'blocks']), blocks)
+                    self.assertEqual(safe2._load_slice(b'key',
+                                        sl.first_index).value, b'!!!!')
+                    safe2._write_block(0, safe2._eg_encrypt_block(b'k', 0,
+                            b'', Crypto.Random.new().read, annex=True))
+                    safe2.close()
+            f.seek(0)
+            safe2 = pol.safe.Safe.load_from_stream(f, None, False)
+            self.assertEqual(list(safe2.data[b'blocks']), blocks)
+        f = io.BytesIO()
+        safe.store_to_stream(f)
+        with self.assertRaises(pol.safe.SafeFormatError):
+            pol.safe.Safe.load_from_stream(io.BytesIO(f.getvalue()[:-1]),
+                                            None, False)
+    def test_load_msgpack(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=20)
+        sl = safe._new_slice(5)
+        sl.store(b'key', b'!!!!', annex=True)
+        safe.sync_blocks()
+        blocks = list(safe.data[b'blocks'])
+        # Older safes might have their blocks before the group parameters
+        data = {b'blocks': blocks}
+        data.update((k, v) for k, v in safe.data.items() if k != b'blocks')
+        for stream in (io.BytesIO(pol.safe.SAFE_MAGIC
+                                + msgpack.packb(data, use_bin_type=True)),
+                       io.BytesIO(pol.safe.SAFE_MAGIC
+                                + msgpack.packb(safe.data,
+                                    use_bin_type=True,
+                                    default=_msgpack_default))):
+            safe2 = pol.safe.Safe.load_from_stream(stream, None, False)
+            self.assertEqual(list(safe2.data[b'blocks']), blocks)
+            self.assertEqual(safe2._load_slice(b'key', sl.first_index).value,
+                                b'!!!!')
+        data[b'blocks'] = [[b'', b'', b'']] * 20
+        with self.assertRaises(pol.safe.SafeFormatError):
+            pol.safe.Safe.load_from_stream(io.BytesIO(pol.safe.SAFE_MAGIC
+                            + msgpack.packb(data, use_bin_type=True)),
+                            None, False)
+    def test_pack_msgpack(self):
+        n_blocks = 2 * pol.safe.PACK_CHUNK_SIZE + 3
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=n_blocks)
+        randfunc = Crypto.Random.new().read
+        blocks = safe.data[b'blocks']
+        for index in range(0, n_blocks, 7):
+            blocks[index] = [randfunc(index % 129), randfunc(128),
+                             randfunc(129), randfunc(32)]
+        safe.format = pol.safe.FORMAT_MSGPACK
+        f = io.BytesIO()
+        safe.store_to_stream(f)
+        self.assertEqual(f.getvalue(), pol.safe.SAFE_MAGIC
+                            + msgpack.packb(safe.data, use_bin_type=True,
+                                        default=_msgpack_default))
+    def test_store_in_place(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'safe')
+            with pol.safe.create(path, precomputed_gp=True,
+                                    n_blocks=100) as safe:
+                safe.format = pol.safe.FORMAT_FIXED
+                sl = safe._new_slice(2)
+                sl.store(b'key', b'!!!!', annex=True)
+                first_index = sl.first_index
+            ino = os.stat(path).st_ino
+            with pol.safe.open(path, rerandomize_fraction=0.1) as safe:
+                with _builtin_open(path, 'rb') as f:
+                    old = f.read()
+                safe._load_slice(b'key', first_index).store(b'key', b'????')
+                buf = safe.data[b'blocks'].buf
+            # The file was changed in place: only the rerandomized blocks
+            # and the header differ.  It is mapped again.
+            self.assertEqual(os.stat(path).st_ino, ino)
+            self.assertIsNot(safe.data[b'blocks'].buf, buf)
+            self.assertFalse(os.path.exists(path + pol.safe.JOURNAL_SUFFIX))
+            with _builtin_open(path, 'rb') as f:
+                new = f.read()
+            record_size = safe.data[b'blocks'].record_size
+            changed = len(set((i - 4096) // record_size
+                                for i in range(4096, len(new))
+                                if old[i] != new[i]))
+            self.assertLessEqual(changed, 12)
+            with pol.safe.open(path, readonly=True) as safe:
+                self.assertEqual(safe._load_slice(b'key', first_index).value,
+                                    b'????')
+            # Without the fraction, all blocks change: the safe is rewritten.
+            with pol.safe.open(path) as safe:
+                pass
+            self.assertNotEqual(os.stat(path).st_ino, ino)
+        finally:
+            shutil.rmtree(d)
+    def test_journal(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'safe')
+            with _builtin_open(path, 'wb') as f:
+                f.write(b'0123456789')
+            # An incomplete journal is discarded
+            pol.safe._write_journal(path, [(2, b'ab'), (8, b'cd')])
+            with _builtin_open(path + pol.safe.JOURNAL_SUFFIX, 'rb') as f:
+                journal = f.read()
+            with _builtin_open(path + pol.safe.JOURNAL_SUFFIX, 'wb') as f:
+                f.write(journal[:-1])
+            pol.safe._replay_journal(path)
+            self.assertFalse(os.path.exists(path + pol.safe.JOURNAL_SUFFIX))
+            with _builtin_open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'0123456789')
+            # A complete one is applied
+            with _builtin_open(path + pol.safe.JOURNAL_SUFFIX, 'wb') as f:
+                f.write(journal)
+            pol.safe._replay_journal(path)
+            self.assertFalse(os.path.exists(path + pol.safe.JOURNAL_SUFFIX))
+            with _builtin_open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'01ab4567cd')
+        finally:
+            shutil.rmtree(d)
+    def test_create_removes_journal(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'safe')
+            with _builtin_open(path, 'wb') as f:
+                f.write(b'0123456789')
+            pol.safe._write_journal(path, [(0, b'garbage')])
+            with pol.safe.create(path, override=True, precomputed_gp=True,
+                                    n_blocks=10) as safe:
+                pass
+            self.assertFalse(os.path.exists(path + pol.safe.JOURNAL_SUFFIX))
+            with pol.safe.open(path, readonly=True) as safe:
+                self.assertEqual(len(safe.data[b'blocks']), 10)
+        finally:
+            shutil.rmtree(d)
     def test_load_slice(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
         sl = safe._new_slice(5)
@@ -63,7 +370,10 @@ class TestElgamalSafe(unittest.TestCase):
         randfunc = Crypto.Random.new().read
         data = randfunc(sl.size)
         sl.store(b'key', data, annex=True)
-        self.assertEqual(safe._load_slice(b'key', sl.first_index).value, data)
+        loaded = safe._load_slice(b'key', sl.first_index)
+        self.assertEqual(loaded.value, data)
+        # The indices do not all fit in the first block
+        self.assertEqual(loaded.indices, sl.indices)
     def test_open_containers(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         safe.new_container(b'm', b'l', b'a', nblocks=70)
@@ -86,6 +396,16 @@ class TestElgamalSafe(unittest.TestCase):
         c_a = cs_a[0]
         self.assertTrue(c_a.can_add)
         del(cs_a, c_a); self._assert_no_open_containers(safe)
+    def test_open_containers_many(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=140)
+        safe.new_container(b'm', b'l', b'a', nblocks=70)
+        safe.new_container(b'm2', nblocks=70)
+        self.assertEqual(safe.open_containers_many([]), [])
+        ret = safe.open_containers_many([b'm2', b'wrong', b'l', b'm'])
+        self.assertEqual([len(cs) for cs in ret], [1, 0, 1, 1])
+        self.assertIs(ret[2][0], ret[3][0])
+        self.assertIsNot(ret[0][0], ret[2][0])
+        del(ret); self._assert_no_open_containers(safe)
     def test_additional_keys(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         safe.new_container(b'm', b'l', b'a', nblocks=30,
@@ -143,6 +463,99 @@ class TestElgamalSafe(unittest.TestCase):
         c = list(safe.open_containers(b'l'))[0]
         self._check_container(c)
         del(c); self._assert_no_open_containers(safe)
+    def test_secrets_encoding(self):
+        # By default, the secrets are stored such that older versions of
+        # pol can read them.
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
+        safe.new_container(b'm', nblocks=70)
+        c = list(safe.open_containers(b'm'))[0]
+        c.add('key', 'note', 'secret')
+        c.save()
+        pt = safe._cipherstream(c.full_key, c.main_data.iv).decrypt(
+                                c.main_data.secrets)
+        self.assertNotEqual(pt[:1], pol.serialization.FMT_INDEXED)
+        self.assertEqual(pol.serialization.decode_bytes_in_son(
+                            pol.serialization.string_to_son(pt)[1]),
+                         ['secret'])
+        del(c); self._assert_no_open_containers(safe)
+        c = list(safe.open_containers(b'm'))[0]
+        self.assertIsInstance(c.secret_data.entries, list)
+        self.assertEqual([e.secret for e in c.list()], ['secret'])
+    def test_lazy_secrets(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
+        # Only safes in the fixed format use the indexed encoding
+        safe.format = pol.safe.FORMAT_FIXED
+        safe.new_container(b'm', nblocks=70)
+        c = list(safe.open_containers(b'm'))[0]
+        for i in range(5):
+            c.add('key%s' % i, 'note', 'secret%s' % i)
+        c.save()
+        del(c); self._assert_no_open_containers(safe)
+
+        c = list(safe.open_containers(b'm'))[0]
+        entries = c.list()
+        self.assertEqual([e.key for e in entries],
+                         ['key%s' % i for i in range(5)])
+        # Only the secrets that are read, are decrypted
+        self.assertEqual(entries[3].secret, 'secret3')
+        self.assertEqual(
+            [x is not pol.safe._NOT_DECRYPTED
+                    for x in c.secret_data.entries.secrets],
+            [False, False, False, True, False])
+        entries[1].secret = 'changed'
+        entries[2].remove()
+        c.add('key5', 'note', 'secret5')
+        c.save()
+        del(c, entries); self._assert_no_open_containers(safe)
+
+        c = list(safe.open_containers(b'm'))[0]
+        self.assertEqual([(e.key, e.secret) for e in c.list()],
+                         [('key0', 'secret0'), ('key1', 'changed'),
+                          ('key3', 'secret3'), ('key4', 'secret4'),
+                          ('key5', 'secret5')])
+        # Secrets stored by an older version of pol can still be read
+        sbs = safe.cipher.blocksize
+        iv = b'!' * sbs
+        c.main_data = c.main_data._replace(iv=iv,
+                secrets=safe._cipherstream(c.full_key, iv).encrypt(
+                    pol.serialization.son_to_string(c.secret_data._replace(
+                        entries=list(c.secret_data.entries)))))
+        c.main_slice.store(c.list_key,
+                    pol.serialization.son_to_string(c.main_data))
+        del(c); self._assert_no_open_containers(safe)
+
+        c = list(safe.open_containers(b'm'))[0]
+        self.assertIsInstance(c.secret_data.entries, list)
+        self.assertEqual([e.secret for e in c.list()],
+                         ['secret0', 'changed', 'secret3', 'secret4',
+                          'secret5'])
+    def test_key_index(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
+        c = safe.new_container(b'm', b'l', b'a', nblocks=70)
+        self._fill_container(c)
+        c.add('Key1', 'note5', 'secret5')
+        self.assertEqual([e.note for e in c.get('key1')], ['note1'])
+        self.assertEqual([e.note for e in c.get('KEY1', ignore_case=True)],
+                         ['note1', 'note5'])
+        self.assertEqual(list(c.get('KEY1')), [])
+        # The index follows changes to the entries
+        list(c.get('key4'))[0].key = 'key1'
+        self.assertEqual([e.note for e in c.get('key1')], ['note1', 'note4'])
+        self.assertEqual(len(list(c.get('key4'))), 1)
+        list(c.get('key1'))[0].remove()
+        self.assertEqual([e.note for e in c.get('key1')], ['note4'])
+        c.add('key1', 'note6', 'secret6')
+        self.assertEqual([e.note for e in c.get('key1')], ['note4', 'note6'])
+        c.save()
+        del(c)
+        # Also for entries moved from the append slice
+        c = list(safe.open_containers(b'a'))[0]
+        c.add('KEY1', 'note7', 'secret7')
+        c.save()
+        del(c)
+        c = list(safe.open_containers(b'm'))[0]
+        self.assertEqual([e.note for e in c.get('key1', ignore_case=True)],
+                         ['note4', 'note5', 'note6', 'note7'])
     def test_append_data(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         safe.new_container(b'm', b'l', b'a', nblocks=70)
@@ -172,6 +585,49 @@ class TestElgamalSafe(unittest.TestCase):
 
         c = list(safe.open_containers(b'l', move_append_entries=False))[0]
         self._check_container(c)
+    def test_append_entries_cache(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
+        safe.new_container(b'm', b'l', b'a', nblocks=70)
+        c = list(safe.open_containers(b'a'))[0]
+        self._fill_container(c)
+        c.save()
+        del(c); self._assert_no_open_containers(safe)
+
+        c = list(safe.open_containers(b'm', move_append_entries=False))[0]
+        with unittest.mock.patch.object(safe.envelope, 'open',
+                                        wraps=safe.envelope.open) as m:
+            self._check_container(c)
+            self._check_container_secrets(c)
+            self.assertEqual(len(c.list()), 5)
+            entries = [c.get_by_id(i) for i in c.list_ids()]
+            self.assertEqual([e.key for e in entries],
+                             ['key1', 'key2', 'key3', 'key4', 'key4'])
+            self.assertEqual(m.call_count, 5)
+            # Changes are visible after saving
+            entries[0].key = 'key5'
+            entries[1].remove()
+            c.save()
+            self.assertEqual([e.key for e in c.list()],
+                             ['key5', 'key3', 'key4', 'key4'])
+            self.assertEqual(m.call_count, 9)
+    def test_append_data_parallel(self):
+        for use_threads in (False, True):
+            safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70,
+                                nworkers=2, use_threads=use_threads)
+            self.addCleanup(safe.close)
+            safe.new_container(b'm', b'l', b'a', nblocks=70)
+            c = list(safe.open_containers(b'a'))[0]
+            # The append slice holds only a few entries
+            for i in range(5):
+                c.add('key%s' % i, 'note%s' % i, 'secret%s' % i)
+            c.save()
+            del(c); self._assert_no_open_containers(safe)
+
+            c = list(safe.open_containers(b'm'))[0]
+            self.assertEqual([(e.key, e.note, e.secret) for e in c.list()],
+                             [('key%s' % i, 'note%s' % i, 'secret%s' % i)
+                                for i in range(5)])
+            del(c)
     def test_removal(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         safe.new_container(b'm', b'l', b'a', nblocks=70)
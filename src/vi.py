@@ -127,6 +127,8 @@ class VisualPol(object):
         with self.program._open_safe() as safe:
             self.safe = safe
             self.session = pol.session.Session(safe)
+            # Prepare for the rerandomization on close, while the user types.
+            safe.start_factor_pool()
 
             # Header
             self.header = urwid.AttrWrap(urwid.Text(